@@ -32,4 +32,47 @@ def testPasteAfterForcedLineBreak():
     sp._validate()
 
 
+# replacing the selection must be undoable in one step
+def testReplaceSelected():
+    sp = u.load()
+
+    before = [str(ln) for ln in sp.lines]
+    nextElem = str(sp.lines[1])
+
+    # a whole element is replaced by a separate element
+    sp.cmd("setMark")
+    sp.cmd("moveLineEnd")
+    assert sp.replaceSelected([Line(text="INT. BARN - DAY", lt=scr.SCENE)])
+
+    assert sp.lines[0].text == "INT. BARN - DAY"
+    assert sp.lines[0].lt == scr.SCENE
+    assert sp.lines[0].lb == scr.LB_LAST
+    assert str(sp.lines[1]) == nextElem
+
+    sp._validate()
+
+    sp.cmd("undo")
+    assert [str(ln) for ln in sp.lines] == before
+
+    # undo clears the selection
+    assert not sp.replaceSelected([Line(text="x")])
+
+
+# replacing part of an element pastes into it
+def testReplaceSelectedPartial():
+    sp = u.load()
+
+    text = sp.lines[0].text
+
+    sp.cmd("moveRight", count=4)
+    sp.cmd("setMark")
+    sp.cmd("moveRight", count=2)
+    assert sp.replaceSelected([Line(text="XYZ", lt=scr.ACTION)])
+
+    assert sp.lines[0].text == text[:4] + "XYZ" + text[7:]
+    assert sp.lines[0].lt == scr.SCENE
+
+    sp._validate()
+
+
 # FIXME: lot more tests
@@ -0,0 +1,93 @@
+import os
+import tempfile
+
+from trelby.ai.embedcache import MAX_SIMHASH_DISTANCE, EmbeddingCache, bands, chunk_hash, simhash
+
+# test the on-disk cache of embedding vectors
+
+
+def testGetSet():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "sub", "embeddings.sqlite")
+        ec = EmbeddingCache(path)
+
+        assert ec.get_many("m", ["a", "b"]) == {}
+
+        ec.set_many("m", ["a", "b"], [[1.0, 2.0], [0.5, -1.5]])
+
+        found = ec.get_many("m", ["a", "b", "c"])
+        assert found == {
+            chunk_hash("m", "a"): [1.0, 2.0],
+            chunk_hash("m", "b"): [0.5, -1.5],
+        }
+
+        # vectors are per model
+        assert ec.get_many("other", ["a"]) == {}
+
+        # and kept across sessions
+        ec.conn.close()
+        ec = EmbeddingCache(path)
+        assert ec.get_many("m", ["a"]) == {chunk_hash("m", "a"): [1.0, 2.0]}
+
+        ec.clear()
+        assert ec.get_many("m", ["a"]) == {}
+        ec.conn.close()
+
+
+def testMaxRows():
+    with tempfile.TemporaryDirectory() as tmp:
+        ec = EmbeddingCache(os.path.join(tmp, "embeddings.sqlite"), max_rows=2)
+
+        ec.set_many("m", ["a"], [[1.0]])
+        ec.set_many("m", ["b"], [[2.0]])
+
+        # using "a" makes "b" the least recently used one
+        assert ec.get_many("m", ["a"])
+        ec.set_many("m", ["c"], [[3.0]])
+
+        found = ec.get_many("m", ["a", "b", "c"])
+        assert set(found) == {chunk_hash("m", "a"), chunk_hash("m", "c")}
+        ec.conn.close()
+
+
+def testSimilar():
+    with tempfile.TemporaryDirectory() as tmp:
+        ec = EmbeddingCache(os.path.join(tmp, "embeddings.sqlite"))
+
+        text = ("INT. KITCHEN - NIGHT\nMary stands by the window, watching "
+                "the rain come down over the empty street outside.\nMARY\n"
+                "He said he would be back before midnight.")
+        ec.set_many("m", [text], [[1.0, 2.0]])
+
+        # a fixed typo still uses the cached vector
+        assert ec.get_similar("m", text.replace("midnight", "midnite")) == [1.0, 2.0]
+
+        # whitespace and case don't matter
+        assert ec.get_similar("m", text.upper().replace("\n", "  ")) == [1.0, 2.0]
+
+        assert ec.get_similar("m", "EXT. BEACH - DAY\nWaves.") is None
+        assert ec.get_similar("other", text) is None
+        ec.conn.close()
+
+
+def testSimhash():
+    a = simhash("one two three four five six seven eight nine ten")
+    b = simhash("one two three four five six seven eight nine ten")
+    c = simhash("completely different words in this other sentence here")
+
+    assert a == b
+    assert a != c
+    assert -(1 << 63) <= a < (1 << 63)
+
+
+def testBands():
+    sh = simhash("one two three four five six seven eight nine ten")
+
+    # hashes differing in at most MAX_SIMHASH_DISTANCE bits have a band in
+    # common
+    other = sh ^ sum(1 << (i * 64 // (MAX_SIMHASH_DISTANCE + 1))
+                     for i in range(MAX_SIMHASH_DISTANCE))
+    assert any(x == y for x, y in zip(bands(sh), bands(other)))
+
+    # all bits end up in some band
+    assert sum(bin(b).count("1") for b in bands(-1)) == 64
@@ -0,0 +1,46 @@
+import tests.u as u
+import trelby.screenplay as scr
+
+# test that the cached character names, scene locations and line type
+# counts are updated when the script changes
+
+
+def testCharacterNames():
+    sp = u.load()
+    names = sp.getCharacterNames()
+
+    # changing the returned value must not change the cached one
+    names["nosuchthingie"] = None
+    assert "nosuchthingie" not in sp.getCharacterNames()
+
+    sp.cmd("toCharacter")
+    assert "ext. stonehenge - night" in sp.getCharacterNames()
+
+    sp.cmd("undo")
+    assert "ext. stonehenge - night" not in sp.getCharacterNames()
+
+
+def testSceneLocations():
+    sp = u.load()
+    scenes = sp.getSceneLocations()
+
+    assert sp.getSceneLocations() == scenes
+
+    sp.cmd("toAction")
+    assert len(sp.getSceneLocations()) == len(scenes) - 1
+
+    sp.cmd("undo")
+    assert sp.getSceneLocations() == scenes
+
+
+def testTypeCounts():
+    sp = u.load()
+    counts = sp.getTypeCounts()
+
+    assert sum(counts.values()) == len(sp.lines)
+
+    sp.cmd("toAction")
+    assert sp.getTypeCounts()[scr.ACTION] == counts[scr.ACTION] + 1
+
+    sp.cmd("undo")
+    assert sp.getTypeCounts() == counts
@@ -0,0 +1,46 @@
+from trelby.ai.ratelimit import TokenBucket, get_rate_limiter
+
+# test the client-side request rate limiter
+
+
+def testBurst():
+    tb = TokenBucket(0.001, 3)
+
+    assert tb.try_acquire()
+    assert tb.try_acquire(2)
+    assert not tb.try_acquire()
+
+
+def testRefill():
+    tb = TokenBucket(1000.0, 2)
+
+    assert tb.try_acquire(2)
+
+    tb.last_refill -= 1.0
+
+    assert tb.try_acquire(2)
+
+
+def testBackoff():
+    tb = TokenBucket(10.0, 5)
+
+    tb.backoff()
+
+    assert tb.rate == 5.0
+    assert not tb.try_acquire()
+
+    tb.backoff()
+
+    assert tb.rate == 2.5
+
+    # backoff period over, original rate restored on next refill
+    tb.backoff_until = tb.last_refill
+
+    tb.try_acquire()
+
+    assert tb.rate == 10.0
+
+
+def testSharedPerService():
+    assert get_rate_limiter("anthropic") is get_rate_limiter("anthropic")
+    assert get_rate_limiter("anthropic") is not get_rate_limiter("groq")
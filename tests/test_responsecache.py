@@ -0,0 +1,84 @@
+from trelby.ai.responsecache import ResponseCache, context_hash, conversation_hash
+
+# test the cache of AI responses
+
+
+def testHit():
+    rc = ResponseCache()
+    key = ("anthropic", "m")
+    ctx = context_hash("INT. HOUSE - DAY")
+
+    assert rc.get(key, ctx, "Suggest a scene heading") is None
+
+    rc.set(key, ctx, "Suggest a scene heading", "INT. BARN - NIGHT")
+
+    assert rc.get(key, ctx, "suggest a  scene heading?") == "INT. BARN - NIGHT"
+    assert rc.get(key, ctx, "Improve this dialogue") is None
+
+    # word order and negation matter
+    assert rc.get(key, ctx, "Heading a scene suggest") is None
+    assert rc.get(key, ctx, "Don't suggest a scene heading") is None
+    assert rc.get(("groq", "m"), ctx, "Suggest a scene heading") is None
+
+
+def testContextChange():
+    rc = ResponseCache()
+    key = ("anthropic", "m")
+
+    rc.set(key, context_hash("a"), "Suggest a scene heading", "x")
+
+    assert rc.get(key, context_hash("b"), "Suggest a scene heading") is None
+
+    rc.set(key, context_hash("b"), "Improve this dialogue", "y")
+
+    # entries of each context are kept apart
+    assert rc.get(key, context_hash("a"), "Suggest a scene heading") == "x"
+    assert rc.get(key, context_hash("a"), "Improve this dialogue") is None
+    assert rc.get(key, context_hash("b"), "Improve this dialogue") == "y"
+
+
+def testMaxEntries():
+    rc = ResponseCache(max_entries=2)
+    key = ("anthropic", "m")
+    ctx = context_hash("")
+
+    rc.set(key, ctx, "one", "1")
+    rc.set(key, ctx, "two", "2")
+    rc.set(key, ctx, "three", "3")
+
+    assert rc.get(key, ctx, "one") is None
+    assert rc.get(key, ctx, "two") == "2"
+    assert rc.get(key, ctx, "three") == "3"
+
+
+def testRepeatedQuestion():
+    rc = ResponseCache()
+    key = ("anthropic", "m")
+    history = []
+    requests = []
+
+    # ask a question the way the assistant panel does: the history sent
+    # with it already ends with the question
+    def ask(question, script="script"):
+        history.append({"sender": "You", "message": question, "is_user": True})
+        ctx = conversation_hash(script, "SCRIPT INFO:", history, question)
+
+        response = rc.get(key, ctx, question)
+        if response is None:
+            requests.append(question)
+            response = f"answer {len(requests)}"
+            rc.set(key, ctx, question, response)
+
+        history.append({"sender": "AI Assistant", "message": response, "is_user": False})
+        return response
+
+    assert ask("Suggest a scene heading") == "answer 1"
+    assert ask("Improve this dialogue") == "answer 2"
+
+    # asking again doesn't reach the service, even after other questions
+    assert ask("Suggest a scene heading") == "answer 1"
+    assert ask("improve this dialogue!") == "answer 2"
+    assert requests == ["Suggest a scene heading", "Improve this dialogue"]
+
+    # unless the script has changed
+    assert ask("Suggest a scene heading", script="edited") == "answer 3"
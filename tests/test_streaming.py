@@ -0,0 +1,37 @@
+from trelby.ai.streaming import StreamError, coalesce, error_stream
+
+# test joining the pieces of streamed responses
+
+
+def testMaxPieces():
+    pieces = [str(i % 10) for i in range(40)]
+
+    joined = list(coalesce(iter(pieces), interval=60, max_pieces=16))
+
+    assert [len(j) for j in joined] == [16, 16, 8]
+    assert "".join(joined) == "".join(pieces)
+
+
+def testInterval():
+    # with no interval every piece is passed on at once
+    assert list(coalesce(["a", "b", "c"], interval=0)) == ["a", "b", "c"]
+
+
+def testEmpty():
+    assert list(coalesce([])) == []
+
+
+def testError():
+    pieces = ["Some ", "text", StreamError("Error: overloaded")]
+
+    joined = list(coalesce(iter(pieces), interval=60))
+
+    # an error after some text is not joined with it
+    assert joined == ["Some text", "Error: overloaded"]
+    assert not isinstance(joined[0], StreamError)
+    assert isinstance(joined[1], StreamError)
+
+
+def testErrorStream():
+    assert not isinstance(list(error_stream("Fine"))[0], StreamError)
+    assert isinstance(list(error_stream("Error: failed"))[0], StreamError)
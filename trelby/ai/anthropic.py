@@ -1,32 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import os
-import base64
+import threading
 import anthropic
 from dotenv import load_dotenv
 from .base import AIService
+from .ratelimit import get_rate_limiter
+from .streaming import StreamError
 
-class AnthropicService(AIService):
-    """AI service for Anthropic Claude integration"""
-    
-    def __init__(self, model="claude-3-5-sonnet-20241022"):
-        # Load environment variables
-        load_dotenv()
-        
-        # Get API key from environment
-        api_key = os.getenv('ANTHROPIC_API_KEY')
-        if not api_key:
-            raise ValueError("ANTHROPIC_API_KEY not found in environment variables")
-        
-        # Initialize Claude client
-        self.client = anthropic.Anthropic(api_key=api_key)
-        self.model = model
-
-    def get_response(self, user_message, context="", conversation_history=None, image=None):
-        """Get a response from Claude with optional document context, conversation history, and image"""
-        try:
-            # Build system prompt with context
-            system_prompt = """You are an expert AI assistant specializing in screenwriting and creative storytelling. Your role is to help writers develop compelling narratives, characters, and dialogue.
+SYSTEM_PROMPT = """You are an expert AI assistant specializing in screenwriting and creative storytelling. Your role is to help writers develop compelling narratives, characters, and dialogue.
 
 CORE BEHAVIORS:
 - Provide specific, actionable writing advice based on established screenwriting principles
@@ -75,72 +57,149 @@ IMAGE ANALYSIS:
 - Suggest ways to incorporate visual details into screenplay descriptions
 - Provide feedback on character appearance, setting details, and visual mood"""
 
-            # Add document context if provided
-            if context and context.strip():
-                system_prompt += f"\n\nCURRENT SCREENPLAY CONTEXT:\n{context}"
-            
-            # Build messages array with conversation history
-            messages = []
-            
-            # Add conversation history if provided
-            if conversation_history:
-                for msg in conversation_history:
-                    if msg['message'].strip():  # Only add non-empty messages
-                        role = "user" if msg['is_user'] else "assistant"
-                        messages.append({
-                            "role": role,
-                            "content": msg['message']
-                        })
-            
-            # Add current user message with optional image
-            if image and image.get('data'):
-                # Encode image as base64
-                image_base64 = base64.b64encode(image['data']).decode('utf-8')
-                
-                # Determine image type from filename
-                filename = image.get('filename', '').lower()
-                if filename.endswith('.png'):
-                    media_type = "image/png"
-                elif filename.endswith(('.jpg', '.jpeg')):
-                    media_type = "image/jpeg"
-                elif filename.endswith('.gif'):
-                    media_type = "image/gif"
-                elif filename.endswith('.webp'):
-                    media_type = "image/webp"
-                else:
-                    media_type = "image/jpeg"  # Default
-                
-                # Create message with image
-                messages.append({
-                    "role": "user",
-                    "content": [
-                        {
+# Anthropic clients by API key. Each client keeps a pool of connections to
+# the API, so all services share one instead of each opening their own.
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(api_key):
+    """Get the shared Anthropic client for an API key."""
+    with _clients_lock:
+        client = _clients.get(api_key)
+        if client is None:
+            client = anthropic.Anthropic(api_key=api_key)
+            _clients[api_key] = client
+        
+        return client
+
+class AnthropicService(AIService):
+    """AI service for Anthropic Claude integration"""
+    
+    def __init__(self, model="claude-3-5-sonnet-20241022"):
+        # Load environment variables
+        load_dotenv()
+        
+        # Get API key from environment
+        api_key = os.getenv('ANTHROPIC_API_KEY')
+        if not api_key:
+            raise ValueError("ANTHROPIC_API_KEY not found in environment variables")
+        
+        # Initialize Claude client
+        self.client = get_client(api_key)
+        self.model = model
+        self.rate_limiter = get_rate_limiter("anthropic")
+
+    def build_request(self, user_message, context="", conversation_history=None, image=None):
+        """Build the system prompt blocks and messages for a request. Returns (system, messages)."""
+        # The system prompt and the conversation so far stay the same from
+        # one request to the next, so they come first and the end of them
+        # is marked for Anthropic's prompt cache. The screenplay context
+        # changes with the cursor position, so it is sent after that, with
+        # the current message. Prefixes shorter than the model's minimum
+        # (1024 tokens) are simply not cached.
+        system = [{
+            "type": "text",
+            "text": SYSTEM_PROMPT
+        }]
+        
+        # Build messages array with conversation history
+        messages = []
+        
+        # Add conversation history if provided
+        if conversation_history:
+            for msg in conversation_history:
+                if msg['message'].strip():  # Only add non-empty messages
+                    role = "user" if msg['is_user'] else "assistant"
+                    messages.append({
+                        "role": role,
+                        "content": [{
                             "type": "text",
-                            "text": user_message
-                        },
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": media_type,
-                                "data": image_base64
-                            }
-                        }
-                    ]
-                })
-            else:
-                # Add current user message without image
-                messages.append({
-                    "role": "user",
-                    "content": user_message
-                })
+                            "text": msg['message']
+                        }]
+                    })
+        
+        if messages:
+            messages[-1]["content"][-1]["cache_control"] = {"type": "ephemeral"}
+        else:
+            system[-1]["cache_control"] = {"type": "ephemeral"}
+        
+        # Add current user message with document context and optional image
+        content = []
+        
+        if context and context.strip():
+            content.append({
+                "type": "text",
+                "text": f"CURRENT SCREENPLAY CONTEXT:\n{context}"
+            })
+        
+        content.append({
+            "type": "text",
+            "text": user_message
+        })
+        
+        if image and image.get('b64'):
+            content.append({
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": image['media_type'],
+                    "data": image['b64']
+                }
+            })
+        
+        messages.append({
+            "role": "user",
+            "content": content
+        })
+        
+        return system, messages
+
+    def log_cache_usage(self, usage):
+        """Print how much of the prompt was read from / written to the prompt cache"""
+        print(f"Debug: Prompt cache read {getattr(usage, 'cache_read_input_tokens', 0)} tokens, "
+              f"wrote {getattr(usage, 'cache_creation_input_tokens', 0)} tokens")
+
+    def get_response(self, user_message, context="", conversation_history=None, image=None):
+        """Get a response from Claude with optional document context, conversation history, and image"""
+        # Pace requests so that bursts stay within the service's rate limits
+        self.rate_limiter.acquire()
+        
+        try:
+            system, messages = self.build_request(user_message, context, conversation_history, image)
             
             response = self.client.messages.create(
                 model=self.model,
                 max_tokens=500,
-                system=system_prompt,
+                system=system,
                 messages=messages
             )
+            self.log_cache_usage(response.usage)
             return response.content[0].text
+        except anthropic.RateLimitError as e:
+            self.rate_limiter.backoff()
+            return f"Error: {str(e)}"
+        except Exception as e:
+            return f"Error: {str(e)}"
+
+    def get_response_stream(self, user_message, context="", conversation_history=None, image=None):
+        """Get a response from Claude as a stream of text pieces"""
+        # Pace requests so that bursts stay within the service's rate limits
+        self.rate_limiter.acquire()
+        
+        try:
+            system, messages = self.build_request(user_message, context, conversation_history, image)
+            
+            with self.client.messages.stream(
+                model=self.model,
+                max_tokens=500,
+                system=system,
+                messages=messages
+            ) as stream:
+                for text in stream.text_stream:
+                    yield text
+                self.log_cache_usage(stream.get_final_message().usage)
+        except anthropic.RateLimitError as e:
+            self.rate_limiter.backoff()
+            yield StreamError(f"Error: {str(e)}")
         except Exception as e:
-            return f"Error: {str(e)}" 
\ No newline at end of file
+            yield StreamError(f"Error: {str(e)}") 
\ No newline at end of file
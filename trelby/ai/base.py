@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from abc import ABC, abstractmethod
+from .streaming import error_stream
 
 class AIService(ABC):
     """Abstract base class for AI services."""
@@ -13,7 +14,19 @@ class AIService(ABC):
         :param user_message: The user's message.
         :param context: The screenplay context.
         :param conversation_history: A list of previous messages in the conversation.
-        :param image: Optional image data dictionary with 'data', 'filename', and 'path' keys.
+        :param image: Optional image dictionary with 'b64' (base64 encoded data), 'media_type', 'filename', and 'path' keys.
         :return: The AI's response as a string.
         """
-        pass 
\ No newline at end of file
+        pass
+
+    def get_response_stream(self, user_message, context="", conversation_history=None, image=None):
+        """
+        Get a response from the AI model piece by piece as it is generated.
+        Services that don't support streaming return the whole response as
+        a single piece. If getting the response fails, the last piece is a
+        StreamError.
+
+        Takes the same parameters as get_response.
+        :return: An iterator over pieces of the AI's response text.
+        """
+        return error_stream(self.get_response(user_message, context, conversation_history, image)) 
\ No newline at end of file
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+import array
+import difflib
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+
+# Minimum similarity (as by difflib) of the normalized texts of two chunks
+# for the embedding of one to be used for the other
+DEFAULT_MIN_RATIO = 0.95
+
+# Maximum number of differing bits between the SimHashes of two chunks for
+# them to be compared at all
+MAX_SIMHASH_DISTANCE = 6
+
+# The SimHash is split into this many bands, each stored in an indexed
+# column. Hashes differing in at most MAX_SIMHASH_DISTANCE bits must have
+# at least one band in common, so only rows that do are looked at.
+SIMHASH_BANDS = MAX_SIMHASH_DISTANCE + 1
+
+# Maximum number of the closest cached texts compared in full with a text
+MAX_SIMILAR_CANDIDATES = 8
+
+# Maximum number of vectors kept; the least recently used ones are dropped
+# beyond this. At 1536 dimensions this is about 60 MB.
+DEFAULT_MAX_ROWS = 10000
+
+# Columns of the embeddings table. A table from an older version with
+# other columns is dropped, it only holds cached data.
+_COLUMNS = ([("hash", "TEXT PRIMARY KEY"), ("model", "TEXT"), ("length", "INTEGER"),
+             ("simhash", "INTEGER")] +
+            [(f"band{i}", "INTEGER") for i in range(SIMHASH_BANDS)] +
+            [("text", "TEXT"), ("vector", "BLOB"), ("used", "INTEGER")])
+
+_WORD_RE = re.compile(r"\w+")
+
+def _unpack(blob):
+    """Get the vector stored as blob."""
+    vector = array.array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+def chunk_hash(model, text):
+    """Get the key of the embedding of text made with model."""
+    return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+def normalize(text):
+    """Get text lowercased and with all whitespace runs made single spaces."""
+    return " ".join(text.lower().split())
+
+def simhash(text):
+    """
+    Get the 64-bit SimHash of the word 3-grams of text. Similar texts have
+    hashes differing in only a few bits.
+    """
+    words = _WORD_RE.findall(text.lower())
+    shingles = [" ".join(words[i:i + 3]) for i in range(max(len(words) - 2, 1))]
+    
+    weights = [0] * 64
+    for s in shingles:
+        h = int.from_bytes(hashlib.md5(s.encode("utf-8")).digest()[:8], "big")
+        for bit in range(64):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+    
+    value = 0
+    for bit in range(64):
+        if weights[bit] > 0:
+            value |= 1 << bit
+    
+    # SQLite integers are signed
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def bands(sh):
+    """Split the SimHash sh into SIMHASH_BANDS bands of (nearly) equal size."""
+    sh &= 0xFFFFFFFFFFFFFFFF
+    result = []
+    for i in range(SIMHASH_BANDS):
+        start = i * 64 // SIMHASH_BANDS
+        end = (i + 1) * 64 // SIMHASH_BANDS
+        result.append((sh >> start) & ((1 << (end - start)) - 1))
+    return result
+
+class EmbeddingCache:
+    """
+    On-disk cache of embedding vectors, so that chunks of a screenplay that
+    haven't changed don't need to be embedded again, also across sessions.
+
+    Vectors are keyed by the hash of the embedding model and the chunk
+    text, and stored as float32. A chunk that is only slightly different
+    from a cached one, e.g. by a fixed typo, can use its vector too, see
+    get_similar(). At most max_rows vectors are kept, dropping the least
+    recently used ones.
+    """
+    
+    def __init__(self, path, min_ratio=DEFAULT_MIN_RATIO, max_rows=DEFAULT_MAX_ROWS):
+        """
+        :param path: The SQLite database file to keep the vectors in.
+        :param min_ratio: Minimum similarity for get_similar().
+        :param max_rows: Maximum number of vectors kept.
+        """
+        self.min_ratio = min_ratio
+        self.max_rows = max_rows
+        
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        
+        # Embeddings are created from worker threads
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(embeddings)")]
+        if columns and columns != [name for name, _ in _COLUMNS]:
+            self.conn.execute("DROP TABLE embeddings")
+        
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (%s)" %
+            ", ".join(f"{name} {decl}" for name, decl in _COLUMNS))
+        for i in range(SIMHASH_BANDS):
+            self.conn.execute(
+                f"CREATE INDEX IF NOT EXISTS embeddings_band{i} "
+                f"ON embeddings (model, band{i})")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+        self.conn.commit()
+        
+        # Increasing counter of uses, for dropping the least recently used
+        # vectors
+        self.clock = self.conn.execute("SELECT MAX(used) FROM embeddings").fetchone()[0] or 0
+        self.count = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        
+        self.lock = threading.Lock()
+    
+    def _touch(self, hashes):
+        """Mark the vectors with the given hashes as used (lock held)."""
+        self.clock += 1
+        for i in range(0, len(hashes), 500):
+            part = hashes[i:i + 500]
+            self.conn.execute(
+                "UPDATE embeddings SET used = ? WHERE hash IN (%s)" %
+                ",".join("?" * len(part)), [self.clock] + part)
+        self.conn.commit()
+    
+    def get_many(self, model, texts):
+        """
+        Get the cached vectors of texts.
+
+        :param model: The embedding model the vectors were made with.
+        :param texts: List of texts.
+        :return: Dict of chunk_hash() -> vector of the texts found.
+        """
+        hashes = list({chunk_hash(model, t) for t in texts})
+        found = {}
+        
+        with self.lock:
+            # Stay below SQLite's limit on the number of query parameters
+            for i in range(0, len(hashes), 500):
+                part = hashes[i:i + 500]
+                rows = self.conn.execute(
+                    "SELECT hash, vector FROM embeddings WHERE hash IN (%s)" %
+                    ",".join("?" * len(part)), part)
+                
+                for h, blob in rows:
+                    found[h] = _unpack(blob)
+            
+            if found:
+                self._touch(list(found))
+        
+        return found
+    
+    def get_similar(self, model, text):
+        """
+        Get the cached vector of a text nearly the same as text, or None if
+        there is none.
+
+        Only texts of about the same length with a SimHash band in common
+        are looked at, and of those only the MAX_SIMILAR_CANDIDATES ones
+        with the closest SimHash are compared in full.
+        """
+        norm = normalize(text)
+        if not norm:
+            return None
+        
+        # Texts whose lengths differ more than this can't be similar enough
+        length = len(norm)
+        lo = int(length * self.min_ratio / (2 - self.min_ratio))
+        hi = int(length * (2 - self.min_ratio) / self.min_ratio) + 1
+        sh = simhash(norm)
+        
+        # Each band is looked up in its own index, which SQLite only does
+        # if the model is part of every alternative
+        params = []
+        for band in bands(sh):
+            params += [model, band]
+        
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT hash, simhash FROM embeddings "
+                "WHERE (%s) AND length BETWEEN ? AND ?" %
+                " OR ".join(f"(model = ? AND band{i} = ?)" for i in range(SIMHASH_BANDS)),
+                params + [lo, hi]).fetchall()
+        
+        candidates = []
+        for h, otherSh in rows:
+            distance = bin((sh ^ otherSh) & 0xFFFFFFFFFFFFFFFF).count("1")
+            if distance <= MAX_SIMHASH_DISTANCE:
+                candidates.append((distance, h))
+        
+        candidates.sort()
+        
+        for _, h in candidates[:MAX_SIMILAR_CANDIDATES]:
+            with self.lock:
+                row = self.conn.execute(
+                    "SELECT text, vector FROM embeddings WHERE hash = ?", (h,)).fetchone()
+            if row is None:
+                continue
+            
+            other, blob = row
+            sm = difflib.SequenceMatcher(None, norm, other)
+            if sm.quick_ratio() >= self.min_ratio and sm.ratio() >= self.min_ratio:
+                with self.lock:
+                    self._touch([h])
+                return _unpack(blob)
+        
+        return None
+    
+    def set_many(self, model, texts, vectors):
+        """
+        Store the vectors of texts, made with model, dropping the least
+        recently used vectors if there are more than max_rows.
+        """
+        with self.lock:
+            self.clock += 1
+            
+            rows = []
+            for t, v in zip(texts, vectors):
+                norm = normalize(t)
+                sh = simhash(norm)
+                rows.append([chunk_hash(model, t), model, len(norm), sh] + bands(sh) +
+                            [norm, array.array("f", v).tobytes(), self.clock])
+            
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (%s)" %
+                ",".join("?" * len(_COLUMNS)), rows)
+            
+            # Replaced rows aren't new, so count again only when it may be
+            # needed
+            self.count += len(rows)
+            if self.count > self.max_rows:
+                self.count = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                if self.count > self.max_rows:
+                    self.conn.execute(
+                        "DELETE FROM embeddings WHERE hash IN "
+                        "(SELECT hash FROM embeddings ORDER BY used LIMIT ?)",
+                        (self.count - self.max_rows,))
+                    self.count = self.max_rows
+            
+            self.conn.commit()
+    
+    def clear(self):
+        """Drop all cached vectors."""
+        with self.lock:
+            self.conn.execute("DELETE FROM embeddings")
+            self.conn.commit()
+            self.count = 0
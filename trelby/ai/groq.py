@@ -4,6 +4,8 @@ import os
 import groq
 from dotenv import load_dotenv
 from .base import AIService
+from .ratelimit import get_rate_limiter
+from .streaming import StreamError
 
 class GroqService(AIService):
     """AI service for Groq integration"""
@@ -20,12 +22,12 @@ class GroqService(AIService):
         # Initialize Groq client
         self.client = groq.Groq(api_key=api_key)
         self.model = model
+        self.rate_limiter = get_rate_limiter("groq")
 
-    def get_response(self, user_message, context="", conversation_history=None, image=None):
-        """Get a response from Groq with optional document context and conversation history"""
-        try:
-            # Build system prompt with context
-            system_prompt = """You are an expert AI assistant specializing in screenwriting and creative storytelling. Your role is to help writers develop compelling narratives, characters, and dialogue.
+    def build_messages(self, user_message, context="", conversation_history=None, image=None):
+        """Build the messages array (including the system prompt) for a request"""
+        # Build system prompt with context
+        system_prompt = """You are an expert AI assistant specializing in screenwriting and creative storytelling. Your role is to help writers develop compelling narratives, characters, and dialogue.
 
 CORE BEHAVIORS:
 - Provide specific, actionable writing advice based on established screenwriting principles
@@ -68,38 +70,48 @@ CONVERSATION MEMORY:
 - Maintain continuity in your advice and suggestions
 - Don't repeat information already discussed unless specifically asked"""
 
-            # Add document context if provided
-            if context and context.strip():
-                system_prompt += f"\n\nCURRENT SCREENPLAY CONTEXT:\n{context}"
-            
-            # Note: Groq doesn't support images, so we ignore the image parameter
-            if image:
-                user_message += "\n\n[Note: An image was provided but this model doesn't support image analysis. Please describe the image in your message if you need help with it.]"
-            
-            # Build messages array with conversation history
-            messages = []
-            
-            # Add system message first
-            messages.append({
-                "role": "system",
-                "content": system_prompt
-            })
-            
-            # Add conversation history if provided
-            if conversation_history:
-                for msg in conversation_history:
-                    if msg['message'].strip():  # Only add non-empty messages
-                        role = "user" if msg['is_user'] else "assistant"
-                        messages.append({
-                            "role": role,
-                            "content": msg['message']
-                        })
-            
-            # Add current user message
-            messages.append({
-                "role": "user",
-                "content": user_message
-            })
+        # Add document context if provided
+        if context and context.strip():
+            system_prompt += f"\n\nCURRENT SCREENPLAY CONTEXT:\n{context}"
+        
+        # Note: Groq doesn't support images, so we ignore the image parameter
+        if image:
+            user_message += "\n\n[Note: An image was provided but this model doesn't support image analysis. Please describe the image in your message if you need help with it.]"
+        
+        # Build messages array with conversation history
+        messages = []
+        
+        # Add system message first
+        messages.append({
+            "role": "system",
+            "content": system_prompt
+        })
+        
+        # Add conversation history if provided
+        if conversation_history:
+            for msg in conversation_history:
+                if msg['message'].strip():  # Only add non-empty messages
+                    role = "user" if msg['is_user'] else "assistant"
+                    messages.append({
+                        "role": role,
+                        "content": msg['message']
+                    })
+        
+        # Add current user message
+        messages.append({
+            "role": "user",
+            "content": user_message
+        })
+        
+        return messages
+
+    def get_response(self, user_message, context="", conversation_history=None, image=None):
+        """Get a response from Groq with optional document context and conversation history"""
+        # Pace requests so that bursts stay within the service's rate limits
+        self.rate_limiter.acquire()
+        
+        try:
+            messages = self.build_messages(user_message, context, conversation_history, image)
             
             response = self.client.chat.completions.create(
                 model=self.model,
@@ -107,5 +119,31 @@ CONVERSATION MEMORY:
                 messages=messages
             )
             return response.choices[0].message.content
+        except groq.RateLimitError as e:
+            self.rate_limiter.backoff()
+            return f"Error: {str(e)}"
+        except Exception as e:
+            return f"Error: {str(e)}"
+
+    def get_response_stream(self, user_message, context="", conversation_history=None, image=None):
+        """Get a response from Groq as a stream of text pieces"""
+        # Pace requests so that bursts stay within the service's rate limits
+        self.rate_limiter.acquire()
+        
+        try:
+            messages = self.build_messages(user_message, context, conversation_history, image)
+            
+            stream = self.client.chat.completions.create(
+                model=self.model,
+                max_tokens=500,
+                messages=messages,
+                stream=True
+            )
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except groq.RateLimitError as e:
+            self.rate_limiter.backoff()
+            yield StreamError(f"Error: {str(e)}")
         except Exception as e:
-            return f"Error: {str(e)}" 
\ No newline at end of file
+            yield StreamError(f"Error: {str(e)}") 
\ No newline at end of file
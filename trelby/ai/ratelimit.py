@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+# Default request limits per service as (requests per second, burst size).
+# These are kept a bit under the providers' published per-minute limits.
+DEFAULT_LIMITS = {
+    "anthropic": (50 / 60, 50),
+    "groq": (30 / 60, 30),
+}
+
+class TokenBucket:
+    """
+    Client-side token bucket used to pace requests to an AI service so that
+    bursts of sends don't run into the server's rate limits.
+    """
+    
+    def __init__(self, rate, capacity):
+        """
+        :param rate: Tokens added per second.
+        :param capacity: Maximum number of tokens the bucket can hold.
+        """
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        
+        # While backing off after a rate limit error, the refill rate is
+        # reduced until this time
+        self.backoff_until = 0.0
+        
+        self.lock = threading.Lock()
+    
+    def _refill(self, now):
+        if self.backoff_until and now >= self.backoff_until:
+            self.rate = self.base_rate
+            self.backoff_until = 0.0
+        
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+    
+    def try_acquire(self, n=1):
+        """Take n tokens if available. Returns True on success, False otherwise."""
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= n:
+                self.tokens -= n
+                return True
+            return False
+    
+    def acquire(self, n=1):
+        """Take n tokens, sleeping until enough of them are available."""
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+    
+    def backoff(self, duration=60.0):
+        """
+        Slow down after the server reported a rate limit error: halve the
+        refill rate (again on every further error) for the given number of
+        seconds and drop any saved-up burst.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate /= 2
+            self.tokens = 0.0
+            self.backoff_until = now + duration
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def get_rate_limiter(service_name):
+    """
+    Get the token bucket shared by all instances of the given service.
+    Provider limits apply per API key, not per model, so all models of a
+    service share one bucket.
+    """
+    with _buckets_lock:
+        bucket = _buckets.get(service_name)
+        if bucket is None:
+            rate, capacity = DEFAULT_LIMITS.get(service_name, (1.0, 10))
+            bucket = TokenBucket(rate, capacity)
+            _buckets[service_name] = bucket
+        return bucket
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import hashlib
+import re
+import threading
+
+# Maximum number of responses kept per (service, model)
+DEFAULT_MAX_ENTRIES = 64
+
+_WORD_RE = re.compile(r"\w+")
+
+def context_hash(context):
+    """Get a short hash identifying the given screenplay context."""
+    return hashlib.sha256(context.encode("utf-8")).hexdigest()[:16]
+
+def normalize(message):
+    """
+    Normalize a question for lookups: its words, in order, lowercased, so
+    that only differences in case, whitespace and punctuation are ignored.
+    """
+    return " ".join(_WORD_RE.findall(message.lower()))
+
+def conversation_hash(script_hash, context, history, message):
+    """
+    Get the context hash of a question asked in a conversation, for use
+    with ResponseCache.
+
+    The history sent with a question ends with the question itself, and
+    asking it again adds the earlier exchange about it. So only the turns
+    before the question, and before the first time the same question was
+    asked, are part of the hash. This way, asking the same question again
+    about the same script state gives the same hash.
+
+    :param script_hash: Hash of the whole screenplay.
+    :param context: The screenplay context sent with the question.
+    :param history: The conversation history sent with the question, a
+        list of dicts with 'sender', 'message' and 'is_user' keys.
+    :param message: The user's question.
+    """
+    prior = list(history)
+    while prior and prior[-1]['is_user']:
+        prior.pop()
+    
+    question = normalize(message)
+    for i, item in enumerate(prior):
+        if item['is_user'] and normalize(item['message']) == question:
+            del prior[i:]
+            break
+    
+    turns = "\x00".join(f"{item['sender']}\x01{item['message']}" for item in prior)
+    context = " ".join(context.split())
+    
+    return context_hash(f"{script_hash}\x00{context}\x00{turns}")
+
+class ResponseCache:
+    """
+    Cache of AI responses for recently asked questions, so that asking the
+    same question again about an unchanged screenplay doesn't need another
+    request to the service.
+
+    Questions only match if they are the same after normalize() and were
+    asked in the same context. Entries are kept per (service, model), and
+    the least recently used ones are dropped once there are more than
+    max_entries.
+    """
+    
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        :param max_entries: Maximum number of responses kept per service and model.
+        """
+        self.max_entries = max_entries
+        
+        # (service, model) -> OrderedDict of (context hash, question) -> response
+        self.entries = {}
+        
+        self.lock = threading.Lock()
+    
+    def get(self, key, ctx_hash, message):
+        """
+        Get the cached response for message, or None if there is none.
+
+        :param key: The (service, model) the question is for.
+        :param ctx_hash: Hash of the context, see context_hash().
+        :param message: The user's question.
+        """
+        question = normalize(message)
+        if not question:
+            return None
+        
+        with self.lock:
+            entries = self.entries.get(key)
+            if entries is None:
+                return None
+            
+            response = entries.get((ctx_hash, question))
+            if response is not None:
+                entries.move_to_end((ctx_hash, question))
+            
+            return response
+    
+    def set(self, key, ctx_hash, message, response):
+        """Store the response to a question asked in the given context."""
+        question = normalize(message)
+        if not question or not response:
+            return
+        
+        with self.lock:
+            entries = self.entries.setdefault(key, collections.OrderedDict())
+            
+            entries[(ctx_hash, question)] = response
+            entries.move_to_end((ctx_hash, question))
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+    
+    def clear(self):
+        """Drop all cached responses."""
+        with self.lock:
+            self.entries.clear()
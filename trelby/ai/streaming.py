@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+# Longest time, in seconds, and largest number of pieces a streamed
+# response is collected for before they are passed on together
+DEFAULT_INTERVAL = 0.05
+DEFAULT_MAX_PIECES = 16
+
+class StreamError(str):
+    """
+    The error message of a streamed response that failed, yielded as its
+    last piece. It may follow pieces of text that were already received, so
+    callers must check for it instead of the text starting with "Error".
+    """
+
+def error_stream(response):
+    """
+    Get a whole response as a stream of a single piece, which is a
+    StreamError if the response is an error message.
+    """
+    if response.startswith("Error"):
+        response = StreamError(response)
+    yield response
+
+def coalesce(pieces, interval=DEFAULT_INTERVAL, max_pieces=DEFAULT_MAX_PIECES):
+    """
+    Join the pieces of a streamed response into fewer, larger ones, so that
+    showing them doesn't need a GUI update for every single token.
+
+    A joined piece is yielded once max_pieces have been collected, or when
+    a piece arrives more than interval seconds after the last yield. The
+    rest is yielded when the stream ends. A StreamError is never joined
+    with other pieces, so that it can still be told apart.
+
+    :param pieces: An iterator over pieces of text.
+    :return: An iterator over joined pieces of text.
+    """
+    buf = []
+    last = time.monotonic()
+    
+    for piece in pieces:
+        if isinstance(piece, StreamError):
+            if buf:
+                yield "".join(buf)
+                buf = []
+            yield piece
+            continue
+        
+        buf.append(piece)
+        
+        now = time.monotonic()
+        if len(buf) >= max_pieces or (now - last) >= interval:
+            yield "".join(buf)
+            buf = []
+            last = now
+    
+    if buf:
+        yield "".join(buf)
@@ -1,17 +1,192 @@
 # -*- coding: utf-8 -*-
 
 import wx
+import collections
+import functools
+import io
+import itertools
+import re
 import time
 import threading
 import hashlib
 import base64
+import mimetypes
 import os
+import queue
 from trelby.appearance_utils import get_ai_pane_colors
 from trelby.ai_suggestion import AISuggestionManager
-from trelby.embedding_service import EmbeddingService
-from trelby.ai_service import AIService
 import trelby.screenplay as screenplay
 
+# Available services and their models. The first model of each service is
+# its default.
+AVAILABLE_SERVICES = {
+    "anthropic": (
+        "claude-3-5-sonnet-20241022",
+        "claude-3-5-haiku-20241022",
+        "claude-3-opus-20240229",
+        "claude-3-sonnet-20240229",
+        "claude-3-haiku-20240307"
+    ),
+    "groq": (
+        "llama3-8b-8192",
+        "llama3-70b-8192",
+        "mixtral-8x7b-32768",
+        "gemma2-9b-it",
+        "llama2-70b-4096"
+    )
+}
+
+# Models that support image input
+IMAGE_SUPPORT = {
+    "anthropic": frozenset(AVAILABLE_SERVICES["anthropic"]),
+    "groq": frozenset()  # Groq models don't support images yet
+}
+
+WELCOME_MESSAGE = (
+    "Hello! I'm your AI writing assistant with automatic semantic search. I can help you with:\n\n"
+    "• Character development and analysis\n"
+    "• Plot suggestions and story structure\n"
+    "• Dialogue improvements\n"
+    "• Scene analysis and suggestions\n"
+    "• Story themes and motifs\n\n"
+    "I'll automatically analyze your screenplay and provide context-aware suggestions!"
+)
+
+# Largest image file that can be attached to a message. Anthropic rejects
+# images over 5 MB.
+MAX_IMAGE_SIZE = 5 * 1024 * 1024
+
+# Image types the AI services accept; others are sent as JPEG
+IMAGE_MEDIA_TYPES = ("image/png", "image/jpeg", "image/gif", "image/webp")
+
+# Number of chat messages kept in the history
+MAX_CHAT_HISTORY = 200
+
+# Number of most recent chat messages sent to the AI service with each
+# request. Older messages are only sent as a short summary.
+HISTORY_WINDOW = 12
+
+# Maximum length of the summary of older messages, and of each message in it
+MAX_SUMMARY_LENGTH = 2000
+MAX_SUMMARY_MESSAGE_LENGTH = 150
+
+# Longest image side Anthropic uses. Larger images are scaled down to this
+# before sending, they would be anyway and just take longer to upload.
+MAX_IMAGE_SIDE = 1568
+
+@functools.lru_cache(maxsize=16)
+def _scaled_image(path, mtime_ns, max_width, max_height):
+    """
+    Get the image at path scaled to fit in max_width x max_height. mtime_ns
+    is only used as part of the cache key, so that a changed file is loaded
+    again. Doesn't use anything GUI related, so can be called from any
+    thread.
+    """
+    # Load the image
+    image = wx.Image(path)
+    
+    img_width, img_height = image.GetSize()
+    
+    # Calculate scaling factor
+    scale_x = max_width / img_width
+    scale_y = max_height / img_height
+    scale = min(scale_x, scale_y)
+    
+    # Images that already fit are used as they are
+    if scale >= 1.0:
+        return image
+    
+    # Resize image
+    new_width = max(1, round(img_width * scale))
+    new_height = max(1, round(img_height * scale))
+    
+    # Bilinear is much faster and looks the same at preview sizes
+    return image.Scale(new_width, new_height, wx.IMAGE_QUALITY_BILINEAR)
+
+def _keywords_re(keywords):
+    """Compile a case-insensitive pattern matching any of the keywords anywhere in a string"""
+    return re.compile("|".join(re.escape(k) for k in keywords), re.IGNORECASE)
+
+# Whether to offer adding script content from AI responses to the script as
+# soon as they arrive. Disabled for now, as it pops up a dialog for nearly
+# every response.
+OFFER_ADD_TO_SCRIPT = False
+
+# Words suggesting an AI response contains something to add to the script
+_ACTIONABLE_RE = _keywords_re([
+    'scene', 'character', 'dialogue', 'action', 'description', 'setting',
+    'location', 'interior', 'exterior', 'day', 'night', 'morning', 'evening',
+    'close up', 'wide shot', 'medium shot', 'fade', 'cut to', 'dissolve'
+])
+
+# Words marking a line as an explanation or commentary rather than script content
+_FALLBACK_SKIP_RE = _keywords_re([
+    'here\'s', 'here is', 'i suggest', 'you could', 'consider',
+    'try this', 'example', 'suggestion', 'note:', 'tip:', 'advice:'
+])
+_SKIP_RE = _keywords_re([
+    'here\'s', 'here is', 'i suggest', 'you could', 'consider',
+    'try this', 'example', 'suggestion', 'note:', 'tip:', 'advice:',
+    'ai assistant:', 'claude:', 'assistant:', 'user:', 'you:'
+])
+
+# Words marking a line as script content
+_SCRIPT_LINE_RE = _keywords_re([
+    'int.', 'ext.', 'scene', 'action', 'dialogue', 'character',
+    '(', ')', 'fade', 'cut', 'dissolve', 'close up', 'wide shot'
+])
+
+# An empty or whitespace-only line
+_BLANK_LINE_RE = re.compile(r"^[ \t\r\f\v]*$", re.MULTILINE)
+
+# Phrases AI responses start content with, removed before inserting it
+_AI_PREFIXES = (
+    "AI Assistant: ",
+    "Here's a ",
+    "Here is a ",
+    "I suggest ",
+    "You could write ",
+    "Consider adding ",
+    "Try this: ",
+    "Here's an example: ",
+    "Example: ",
+    "Suggestion: "
+)
+
+# Any number of the above at the start of a string, so that they are all
+# removed in one pass
+_AI_PREFIXES_RE = re.compile(r"^(?:(?:%s)\s*)+" % "|".join(re.escape(p) for p in _AI_PREFIXES))
+
+# Line types AI content can be inserted as, and their names, in the order
+# they are offered in
+_INSERT_LINE_TYPES = (
+    screenplay.ACTION,
+    screenplay.SCENE,
+    screenplay.CHARACTER,
+    screenplay.DIALOGUE,
+    screenplay.PAREN
+)
+_INSERT_LINE_TYPE_NAMES = ("Action Line", "Scene Heading", "Character Name", "Dialogue", "Parenthetical")
+
+# Words hinting whether a scene heading should be INT. or EXT.
+_INT_WORDS_RE = _keywords_re(['inside', 'interior', 'room', 'house', 'building', 'office'])
+_EXT_WORDS_RE = _keywords_re(['outside', 'exterior', 'street', 'park', 'forest', 'beach'])
+
+def _is_script_line(line):
+    """Check if a stripped, non-empty line of an AI response looks like script content"""
+    # The cheap checks come first, so that most lines are decided before
+    # the keyword searches
+    n = len(line)
+    if n > 100 or _SKIP_RE.search(line):  # Explanations
+        return False
+    
+    return bool(
+        (n > 3 and line.isupper())  # Likely character names or scene headings
+        or (line[0] == '(' and line[-1] == ')')  # Parentheticals
+        or (n < 80 and not line.startswith('Here') and not line.startswith('I '))  # Short action lines
+        or _SCRIPT_LINE_RE.search(line)
+    )
+
 class AIAssistantPanel(wx.Panel):
     """AI Assistant Panel with automatic semantic search capabilities"""
     
@@ -24,72 +199,87 @@ class AIAssistantPanel(wx.Panel):
         self.embedding_ai_service = None
         self.embeddings_initialized = False
         self.current_screenplay_hash = None
+        
+        # Screenplay the embeddings were last made for
+        self.embedded_screenplay = None
+        
+        # (screenplay, revision) the embeddings were last found to be up to
+        # date for
+        self._last_hash_check = None
+        
+        # Last screenplay hash logged, so that each is only logged once
+        self._last_hash_log = None
         self.processing_lock = threading.Lock()  # Keep lock for thread safety
-        self.chat_history = []  # Add back the missing chat history
-        self.chat_history = []
+        
+        # Messages of the session, only the most recent ones are kept
+        self.chat_history = collections.deque(maxlen=MAX_CHAT_HISTORY)
+        
+        # Most recent messages, which are sent to the AI service, and a
+        # summary of the ones before them
+        self._send_window = collections.deque(maxlen=HISTORY_WINDOW)
+        self._rolling_summary = ""
         self.current_image = None
         
-        # Get appearance-aware colors
-        self.colors = get_ai_pane_colors()
+        # Incremented for every image picked or cleared, so that an image
+        # still loading when another one is picked is ignored once loaded
+        self._image_load_id = 0
         
-        # Available services and models with image support info
-        self.available_services = {
-            "anthropic": [
-                "claude-3-5-sonnet-20241022",
-                "claude-3-5-haiku-20241022",
-                "claude-3-opus-20240229",
-                "claude-3-sonnet-20240229",
-                "claude-3-haiku-20240307"
-            ],
-            "groq": [
-                "llama3-8b-8192",
-                "llama3-70b-8192",
-                "mixtral-8x7b-32768",
-                "gemma2-9b-it",
-                "llama2-70b-4096"
-            ]
-        }
+        # AI services created so far, keyed by (service, model), so that
+        # switching models reuses the existing client instead of building a
+        # new one every time
+        self._service_cache = {}
         
-        # Models that support image input
-        self.image_support = {
-            "anthropic": [
-                "claude-3-5-sonnet-20241022",
-                "claude-3-5-haiku-20241022",
-                "claude-3-opus-20240229",
-                "claude-3-sonnet-20240229",
-                "claude-3-haiku-20240307"
-            ],
-            "groq": []  # Groq models don't support images yet
-        }
+        # User messages sent while a response is still pending
+        self.request_in_flight = False
+        self.pending_messages = []
         
-        # Initialize AI service
-        try:
-            from trelby.ai import get_ai_service
-            self.ai_service = get_ai_service(service_name="anthropic", model="claude-3-5-sonnet-20241022")
-            print("✓ AI service initialized successfully")
-            self.current_service = "anthropic"
-            self.ai_available = True  # Set to True when service is successfully initialized
-        except Exception as e:
-            print(f"✗ Failed to initialize AI service: {e}")
-            self.ai_service = None
-            self.ai_available = False
-            self.current_service = None
+        # AI requests are handled one at a time by a single background
+        # thread, which gets (message, conversation history) from the queue
+        self._req_q = queue.Queue()
+        self._worker = threading.Thread(target=self.ai_worker_loop, daemon=True)
+        self._worker.start()
         
-        # Initialize embedding service
-        try:
-            self.embedding_service = EmbeddingService()
-            print("✓ Embedding service initialized successfully")
-        except Exception as e:
-            print(f"✗ Failed to initialize embedding service: {e}")
-            self.embedding_service = None
+        # Sender and received pieces of the message currently being streamed
+        self.stream_sender = None
+        self.stream_parts = []
+        self.stream_start = 0
         
-        # Initialize embedding AI service
-        try:
-            self.embedding_ai_service = AIService()
-            print("✓ Embedding AI service initialized successfully")
-        except Exception as e:
-            print(f"✗ Failed to initialize embedding AI service: {e}")
-            self.embedding_ai_service = None
+        # Messages added while another one was being streamed, shown once
+        # it's done, as (sender, message, is_user)
+        self.deferred_messages = []
+        
+        # Length of each message in the chat display, in text control
+        # positions, so the oldest ones can be removed from it
+        self._displayed_lengths = collections.deque()
+        
+        # Last basic screenplay context, as ((screenplay, revision, cursor
+        # line), context), so it's only rebuilt after the screenplay changes
+        # or the cursor moves
+        self._ctx_cache = (None, "")
+        
+        # Responses to recent questions, created along with the AI service
+        self.response_cache = None
+        
+        # Get appearance-aware colors
+        self.colors = get_ai_pane_colors()
+        
+        # Available services and models with image support info
+        self.available_services = AVAILABLE_SERVICES
+        self.image_support = IMAGE_SUPPORT
+        
+        # Whether the image button is currently enabled, None until it has
+        # been set up
+        self._image_button_enabled = None
+        
+        # The AI services (and the client libraries behind them) are only
+        # created when first needed, see ensure_ai_service and
+        # ensure_embedding_services. Until then assume the AI is available.
+        # The selected service and model are kept here so they don't need
+        # to be read back from the choice controls.
+        self.current_service = "anthropic"
+        self.current_model = self.available_services["anthropic"][0]
+        self.ai_available = True
+        self.embedding_services_loaded = False
         
         # Initialize UI
         self.init_ui()
@@ -98,14 +288,14 @@ class AIAssistantPanel(wx.Panel):
     
     def init_ui(self):
         """Initialize the UI components"""
-        # Get appearance-aware colors
-        self.colors = get_ai_pane_colors()
+        # The appearance-aware colors are already in self.colors
         
         # Create the main sizer
         main_sizer = wx.BoxSizer(wx.VERTICAL)
         
-        # Create status bar for embedding info
-        self.status_bar = wx.StaticText(self, -1, "Initializing...")
+        # Create status bar for embedding info. The embedding services are
+        # only created when first needed, see ensure_embedding_services.
+        self.status_bar = wx.StaticText(self, -1, "Ready")
         self.status_bar.SetFont(wx.Font(8, wx.FONTFAMILY_DEFAULT, wx.FONTSTYLE_NORMAL, wx.FONTWEIGHT_NORMAL))
         main_sizer.Add(self.status_bar, 0, wx.EXPAND | wx.ALL, 2)
         
@@ -123,7 +313,7 @@ class AIAssistantPanel(wx.Panel):
         model_label = wx.StaticText(self, -1, "Model:")
         model_label.SetForegroundColour(self.colors['text'])
         
-        self.model_choice = wx.Choice(self, -1, choices=self.available_services["anthropic"])
+        self.model_choice = wx.Choice(self, -1, choices=list(self.available_services["anthropic"]))
         self.model_choice.SetSelection(0)  # Default to first model
         self.model_choice.SetBackgroundColour(self.colors['input_background'])
         self.model_choice.SetForegroundColour(self.colors['input_text'])
@@ -160,7 +350,7 @@ class AIAssistantPanel(wx.Panel):
         # Create chat display area
         self.chat_display = wx.TextCtrl(
             self, -1, 
-            style=wx.TE_MULTILINE | wx.TE_READONLY | wx.VSCROLL | wx.BORDER_SUNKEN
+            style=wx.TE_MULTILINE | wx.TE_READONLY | wx.TE_RICH2 | wx.VSCROLL | wx.BORDER_SUNKEN
         )
         self.chat_display.SetBackgroundColour(self.colors['background'])
         self.chat_display.SetForegroundColour(self.colors['text'])
@@ -206,8 +396,8 @@ class AIAssistantPanel(wx.Panel):
         self.update_image_button_state()
         
         # Add welcome message
-        if self.ai_service:
-            welcome_msg = "Hello! I'm your AI writing assistant with automatic semantic search. I can help you with:\n\n• Character development and analysis\n• Plot suggestions and story structure\n• Dialogue improvements\n• Scene analysis and suggestions\n• Story themes and motifs\n\nI'll automatically analyze your screenplay and provide context-aware suggestions!"
+        if self.ai_available:
+            welcome_msg = WELCOME_MESSAGE
         else:
             welcome_msg = "AI Assistant is not available. Please check your API key configuration in the .env file."
         
@@ -219,16 +409,86 @@ class AIAssistantPanel(wx.Panel):
         print("Debug: Legacy process_screenplay_embeddings called, using sync method")
         return self.process_screenplay_embeddings_sync(screenplay)
     
+    def ensure_ai_service(self):
+        """Create the default AI service if that hasn't been done yet. Returns True if the AI service is available."""
+        if self.ai_service is None and self.ai_available:
+            try:
+                self.select_service(self.current_service, self.current_model)
+                print("✓ AI service initialized successfully")
+            except Exception as e:
+                print(f"✗ Failed to initialize AI service: {e}")
+                self.ai_available = False
+                self.add_message("AI Assistant", "AI Assistant is not available. Please check your API key configuration in the .env file.", is_user=False)
+        
+        return self.ai_service is not None
+    
+    def ensure_embedding_services(self):
+        """Create the embedding services if that hasn't been done yet"""
+        with self.processing_lock:
+            if self.embedding_services_loaded:
+                return
+            self.embedding_services_loaded = True
+            
+            # Initialize embedding service
+            try:
+                from trelby.embedding_service import EmbeddingService
+                self.embedding_service = EmbeddingService()
+                print("✓ Embedding service initialized successfully")
+            except Exception as e:
+                print(f"✗ Failed to initialize embedding service: {e}")
+                self.embedding_service = None
+            
+            # Initialize embedding AI service
+            try:
+                from trelby.ai_service import AIService
+                self.embedding_ai_service = AIService()
+                print("✓ Embedding AI service initialized successfully")
+            except Exception as e:
+                print(f"✗ Failed to initialize embedding AI service: {e}")
+                self.embedding_ai_service = None
+                self.update_status("⚠ Semantic search not available")
+    
+    def get_service(self, service_name, model):
+        """Get the AI service for the given service and model, creating it on first use"""
+        key = (service_name, model)
+        service = self._service_cache.get(key)
+        if service is None:
+            from trelby.ai import get_ai_service
+            service = get_ai_service(service_name=service_name, model=model)
+            self._service_cache[key] = service
+        return service
+    
+    def select_service(self, service_name, model):
+        """Use the given service and model for AI requests from now on"""
+        self.ai_service = self.get_service(service_name, model)
+        
+        if self.response_cache is None:
+            from trelby.ai.responsecache import ResponseCache
+            self.response_cache = ResponseCache()
+    
+    def switch_service(self, service_name, model, description):
+        """Switch to the service and model selected by the user, telling the user how it went"""
+        try:
+            self.select_service(service_name, model)
+            self.ai_available = True  # Set to True when service is successfully created
+            self.add_message("AI Assistant", f"Switched to {description}. How can I help you?", is_user=False)
+        except Exception as e:
+            self.ai_available = False  # Set to False if service creation fails
+            self.add_message("AI Assistant", f"Error switching to {description}: {str(e)}", is_user=False)
+    
     def update_status(self, message):
         """Update the status bar message"""
         wx.CallAfter(self.status_bar.SetLabel, message)
     
     def update_image_button_state(self):
         """Update image button state based on current model support"""
-        selected_service = self.service_choice.GetString(self.service_choice.GetSelection())
-        selected_model = self.model_choice.GetString(self.model_choice.GetSelection())
+        supports_images = self.current_model in self.image_support.get(self.current_service, ())
         
-        supports_images = selected_model in self.image_support.get(selected_service, [])
+        # Switching between models that both do or don't support images
+        # needs no changes, which would only repaint the button
+        if supports_images == self._image_button_enabled:
+            return
+        self._image_button_enabled = supports_images
         
         if supports_images:
             self.image_button.Enable()
@@ -247,56 +507,122 @@ class AIAssistantPanel(wx.Panel):
             
             # Get the selected file path
             pathname = fileDialog.GetPath()
-            
-            try:
-                # Read and encode the image
-                with open(pathname, "rb") as image_file:
-                    image_data = image_file.read()
-                    self.current_image = {
-                        'data': image_data,
-                        'filename': os.path.basename(pathname),
-                        'path': pathname
-                    }
-                
-                # Load and display the image preview
-                self.load_image_preview(pathname)
-                
-                # Update UI
-                self.image_label.SetLabel(f"📷 {os.path.basename(pathname)}")
-                self.clear_image_button.Enable()
-                
-                # Add system message about image
-                self.add_message("AI Assistant", f"Image '{os.path.basename(pathname)}' loaded. You can now ask questions about it!", is_user=False)
-                
-            except Exception as e:
-                wx.MessageBox(f"Error loading image: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+        
+        # Decoding, scaling and encoding a large image takes a while, do it
+        # in the background so the panel stays responsive
+        self._image_load_id += 1
+        self.image_label.SetLabel(f"📷 Loading {os.path.basename(pathname)}...")
+        threading.Thread(target=self.load_image, args=(pathname, self._image_load_id),
+                         daemon=True).start()
     
-    def load_image_preview(self, image_path):
-        """Load and display image preview"""
+    def load_image(self, pathname, load_id):
+        """Load an image and its preview, run in a background thread"""
         try:
-            # Load the image
-            image = wx.Image(image_path)
-            
-            # Resize image to fit preview area (max 200x150)
-            max_width = 200
-            max_height = 150
+            # Encode the image once here, so it isn't encoded again for
+            # every message and the raw data isn't kept around
+            encoded = self.encode_image(pathname)
             
-            img_width, img_height = image.GetSize()
+            preview = None
+            if encoded is not None:
+                try:
+                    # Resize image to fit preview area (max 200x150).
+                    # Previews of recently used images are cached, so
+                    # picking the same image again doesn't decode and scale
+                    # it again.
+                    preview = _scaled_image(pathname, os.stat(pathname).st_mtime_ns, 200, 150)
+                except Exception as e:
+                    print(f"Error loading image preview: {e}")
             
-            # Calculate scaling factor
-            scale_x = max_width / img_width
-            scale_y = max_height / img_height
-            scale = min(scale_x, scale_y)
+            wx.CallAfter(self.image_loaded, pathname, load_id, encoded, preview)
+        except Exception as e:
+            wx.CallAfter(self.image_loaded, pathname, load_id, None, None, str(e))
+    
+    def image_loaded(self, pathname, load_id, encoded, preview, error=None):
+        """Use an image loaded by load_image"""
+        # Another image was picked, or this one cleared, in the meantime
+        if load_id != self._image_load_id:
+            return
+        
+        if encoded is None:
+            self.image_label.SetLabel("No image selected" if not self.current_image
+                                      else f"📷 {self.current_image['filename']}")
+            if error is not None:
+                wx.MessageBox(f"Error loading image: {error}", "Error", wx.OK | wx.ICON_ERROR)
+            else:
+                wx.MessageBox(f"The image is too large. The maximum size is {MAX_IMAGE_SIZE // (1024 * 1024)} MB.",
+                              "Error", wx.OK | wx.ICON_ERROR)
+            return
+        
+        image_b64, media_type = encoded
+        self.current_image = {
+            'b64': image_b64,
+            'media_type': media_type,
+            'filename': os.path.basename(pathname),
+            'path': pathname
+        }
+        
+        # Display the image preview
+        self.show_image_preview(preview)
+        
+        # Update UI
+        self.image_label.SetLabel(f"📷 {os.path.basename(pathname)}")
+        self.clear_image_button.Enable()
+        
+        # Add system message about image
+        self.add_message("AI Assistant", f"Image '{os.path.basename(pathname)}' loaded. You can now ask questions about it!", is_user=False)
+    
+    def encode_image(self, pathname):
+        """
+        Get the base64 encoded data and media type of an image file to send
+        to the AI service, scaled down if it is larger than the AI service
+        uses, and converted if it is in a format the AI service doesn't
+        accept (e.g. BMP or TIFF). Returns None if the result is too large
+        to send.
+        """
+        image = wx.Image(pathname)
+        width, height = image.GetSize()
+        media_type = mimetypes.guess_type(pathname)[0]
+        
+        if max(width, height) > MAX_IMAGE_SIDE or media_type not in IMAGE_MEDIA_TYPES:
+            if max(width, height) > MAX_IMAGE_SIDE:
+                scale = MAX_IMAGE_SIDE / max(width, height)
+                image = image.Scale(max(1, int(width * scale)), max(1, int(height * scale)),
+                                    wx.IMAGE_QUALITY_HIGH)
             
-            # Resize image
-            new_width = int(img_width * scale)
-            new_height = int(img_height * scale)
+            # Keep transparency as PNG, everything else compresses much
+            # better as JPEG
+            stream = io.BytesIO()
+            if image.HasAlpha() or image.HasMask():
+                image.SaveFile(stream, wx.BITMAP_TYPE_PNG)
+                media_type = "image/png"
+            else:
+                image.SetOption(wx.IMAGE_OPTION_QUALITY, 85)
+                image.SaveFile(stream, wx.BITMAP_TYPE_JPEG)
+                media_type = "image/jpeg"
             
-            image = image.Scale(new_width, new_height, wx.IMAGE_QUALITY_HIGH)
+            # Encode straight from the stream's buffer rather than a copy
+            data = stream.getbuffer()
+        else:
+            if os.path.getsize(pathname) > MAX_IMAGE_SIZE:
+                return None
             
-            # Convert to bitmap and display
-            bitmap = wx.Bitmap(image)
-            self.image_preview.SetBitmap(bitmap)
+            with open(pathname, "rb") as image_file:
+                data = image_file.read()
+        
+        if len(data) > MAX_IMAGE_SIZE:
+            return None
+        
+        return base64.b64encode(data).decode('ascii'), media_type
+    
+    def show_image_preview(self, image):
+        """Display image preview, or hide it if image is None"""
+        if image is None:
+            self.image_preview.Hide()
+            return
+        
+        try:
+            # Display it
+            self.image_preview.SetBitmap(wx.Bitmap(image))
             self.image_preview.Show()
             
             # Refresh layout
@@ -308,6 +634,7 @@ class AIAssistantPanel(wx.Panel):
     
     def OnClearImage(self, event):
         """Handle image clearing"""
+        self._image_load_id += 1
         self.current_image = None
         self.image_label.SetLabel("No image selected")
         self.clear_image_button.Disable()
@@ -317,111 +644,116 @@ class AIAssistantPanel(wx.Panel):
     
     def OnServiceChange(self, event):
         """Handle service selection change"""
-        selected_service = self.service_choice.GetString(self.service_choice.GetSelection())
+        selected_service = event.GetString()
         
         # Update model choices for the selected service
         models = self.available_services[selected_service]
-        self.model_choice.Clear()
-        for model in models:
-            self.model_choice.Append(model)
+        self.model_choice.Set(list(models))
         self.model_choice.SetSelection(0)
         
         # Update current service
         self.current_service = selected_service
+        self.current_model = models[0]
         
         # Update image button state
         self.update_image_button_state()
         
-        # Try to create new service with first model
-        try:
-            from trelby.ai import get_ai_service
-            self.ai_service = get_ai_service(service_name=selected_service, model=models[0])
-            self.ai_available = True  # Set to True when service is successfully created
-            self.add_message("AI Assistant", f"Switched to {selected_service} with {models[0]}. How can I help you?", is_user=False)
-        except Exception as e:
-            self.ai_available = False  # Set to False if service creation fails
-            self.add_message("AI Assistant", f"Error switching to {selected_service}: {str(e)}", is_user=False)
+        # Switch to the service with its first model
+        self.switch_service(selected_service, models[0], f"{selected_service} with {models[0]}")
     
     def OnModelChange(self, event):
         """Handle model selection change"""
-        selected_service = self.service_choice.GetString(self.service_choice.GetSelection())
-        selected_model = self.model_choice.GetString(self.model_choice.GetSelection())
+        selected_model = event.GetString()
+        self.current_model = selected_model
         
         # Update image button state
         self.update_image_button_state()
         
-        try:
-            # Create new AI service with selected model
-            from trelby.ai import get_ai_service
-            self.ai_service = get_ai_service(service_name=selected_service, model=selected_model)
-            self.ai_available = True  # Set to True when service is successfully created
-            
-            # Add system message about model change
-            self.add_message("AI Assistant", f"Switched to {selected_model}. How can I help you?", is_user=False)
-        except Exception as e:
-            self.ai_available = False  # Set to False if service creation fails
-            self.add_message("AI Assistant", f"Error switching to {selected_model}: {str(e)}", is_user=False)
+        self.switch_service(self.current_service, selected_model, selected_model)
     
     def refresh_appearance(self):
         """Refresh colors when system appearance changes"""
-        self.colors = get_ai_pane_colors()
-        
-        # Update all UI elements with new colors
-        self.chat_display.SetBackgroundColour(self.colors['background'])
-        self.chat_display.SetForegroundColour(self.colors['text'])
-        self.chat_display.Refresh()
-        
-        self.input_text.SetBackgroundColour(self.colors['input_background'])
-        self.input_text.SetForegroundColour(self.colors['input_text'])
-        self.input_text.Refresh()
-        
-        self.send_button.SetBackgroundColour(self.colors['button_background'])
-        self.send_button.SetForegroundColour(self.colors['button_text'])
-        self.send_button.Refresh()
+        colors = get_ai_pane_colors()
         
-        # Update choice colors
-        self.service_choice.SetBackgroundColour(self.colors['input_background'])
-        self.service_choice.SetForegroundColour(self.colors['input_text'])
-        self.service_choice.Refresh()
-        
-        self.model_choice.SetBackgroundColour(self.colors['input_background'])
-        self.model_choice.SetForegroundColour(self.colors['input_text'])
-        self.model_choice.Refresh()
-        
-        # Update image button colors
-        self.image_button.SetBackgroundColour(self.colors['button_background'])
-        self.image_button.SetForegroundColour(self.colors['button_text'])
-        self.image_button.Refresh()
+        # Appearance change events also arrive when none of our colors
+        # changed, in which case there is nothing to repaint
+        changed = set(key for key, colour in colors.items() if self.colors.get(key) != colour)
+        if not changed:
+            return
         
-        self.clear_image_button.SetBackgroundColour(self.colors['button_background'])
-        self.clear_image_button.SetForegroundColour(self.colors['button_text'])
-        self.clear_image_button.Refresh()
+        self.colors = colors
         
-        # Refresh the panel itself
-        self.Refresh()
+        # Update the UI elements whose colors changed, and repaint the
+        # panel and its children once all of them are done
+        self.Freeze()
+        try:
+            for widget, bg_key, fg_key in (
+                (self.chat_display, 'background', 'text'),
+                (self.input_text, 'input_background', 'input_text'),
+                (self.send_button, 'button_background', 'button_text'),
+                (self.service_choice, 'input_background', 'input_text'),
+                (self.model_choice, 'input_background', 'input_text'),
+                (self.image_button, 'button_background', 'button_text'),
+                (self.clear_image_button, 'button_background', 'button_text'),
+            ):
+                if bg_key in changed or fg_key in changed:
+                    widget.SetBackgroundColour(colors[bg_key])
+                    widget.SetForegroundColour(colors[fg_key])
+        finally:
+            self.Thaw()
+        
+        self.Refresh(eraseBackground=False)
     
     def add_message(self, sender, message, is_user=True):
         """Add a message to the chat display"""
+        # Don't put the message in the middle of one being streamed
+        if self.stream_sender is not None:
+            self.deferred_messages.append((sender, message, is_user))
+            return
+        
         # Format the message
         if is_user:
             formatted_message = f"You: {message}\n\n"
         else:
             formatted_message = f"{sender}: {message}\n\n"
         
-        # Add to display
-        current_text = self.chat_display.GetValue()
-        self.chat_display.SetValue(current_text + formatted_message)
+        # Add to display. Only append the new text, rewriting the whole
+        # transcript would make every message cost O(conversation length).
+        start = self.chat_display.GetLastPosition()
+        self.chat_display.AppendText(formatted_message)
+        self.message_displayed(start)
         
         # Scroll to bottom
-        self.chat_display.ShowPosition(len(self.chat_display.GetValue()))
+        self.chat_display.ShowPosition(self.chat_display.GetLastPosition())
         
+        self.store_message(sender, message, is_user)
+    
+    def message_displayed(self, start):
+        """
+        Note that a message starting at position start has been added to the
+        chat display. Only as many messages as are kept in the history are
+        displayed, the oldest ones are removed so the display doesn't keep
+        growing over a long session.
+        """
+        self._displayed_lengths.append(self.chat_display.GetLastPosition() - start)
+        
+        if len(self._displayed_lengths) > MAX_CHAT_HISTORY:
+            self.chat_display.Remove(0, self._displayed_lengths.popleft())
+    
+    def store_message(self, sender, message, is_user):
+        """Store a message that has been shown in the chat in history"""
         # Store in history
-        self.chat_history.append({
+        msg = {
             'sender': sender,
             'message': message,
             'is_user': is_user,
             'timestamp': time.time()
-        })
+        }
+        self.chat_history.append(msg)
+        
+        if len(self._send_window) == self._send_window.maxlen:
+            self.add_to_summary(self._send_window[0])
+        self._send_window.append(msg)
         
         # If it's an AI message and contains actionable content, show "Add to Script" button
         if not is_user and self.is_actionable_content(message):
@@ -429,17 +761,7 @@ class AIAssistantPanel(wx.Panel):
     
     def is_actionable_content(self, message):
         """Check if the AI response contains content that could be added to the script"""
-        # Disable automatic popup for now
-        return False
-        
-        actionable_keywords = [
-            'scene', 'character', 'dialogue', 'action', 'description', 'setting',
-            'location', 'interior', 'exterior', 'day', 'night', 'morning', 'evening',
-            'close up', 'wide shot', 'medium shot', 'fade', 'cut to', 'dissolve'
-        ]
-        
-        message_lower = message.lower()
-        return any(keyword in message_lower for keyword in actionable_keywords)
+        return OFFER_ADD_TO_SCRIPT and bool(_ACTIONABLE_RE.search(message))
     
     def show_add_to_script_button(self, content):
         """Show a button to add AI content to the script"""
@@ -473,7 +795,7 @@ class AIAssistantPanel(wx.Panel):
         
         # Radio buttons for insertion type
         self.insert_type = wx.RadioBox(dialog, -1, "", 
-                                      choices=["Action Line", "Scene Heading", "Character Name", "Dialogue", "Parenthetical"],
+                                      choices=list(_INSERT_LINE_TYPE_NAMES),
                                       majorDimension=1, style=wx.RA_SPECIFY_COLS)
         sizer.Add(self.insert_type, 0, wx.EXPAND | wx.ALL, 5)
         
@@ -497,40 +819,11 @@ class AIAssistantPanel(wx.Panel):
     
     def extract_actionable_content(self, content):
         """Extract just the actionable script content from the AI response"""
-        # Split content into lines
-        lines = content.split('\n')
-        actionable_lines = []
+        # Split content into stripped, non-empty lines
+        lines = [line for line in (l.strip() for l in content.split('\n')) if line]
         
         # Look for lines that appear to be actual script content
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            # Skip lines that are clearly explanations or commentary
-            if any(skip_word in line.lower() for skip_word in [
-                'here\'s', 'here is', 'i suggest', 'you could', 'consider', 
-                'try this', 'example', 'suggestion', 'note:', 'tip:', 'advice:',
-                'ai assistant:', 'claude:', 'assistant:', 'user:', 'you:'
-            ]):
-                continue
-                
-            # Skip lines that are too long (likely explanations)
-            if len(line) > 100:
-                continue
-                
-            # Look for lines that look like script content
-            if any(keyword in line.lower() for keyword in [
-                'int.', 'ext.', 'scene', 'action', 'dialogue', 'character',
-                '(', ')', 'fade', 'cut', 'dissolve', 'close up', 'wide shot'
-            ]):
-                actionable_lines.append(line)
-            elif line.isupper() and len(line) > 3:  # Likely character names or scene headings
-                actionable_lines.append(line)
-            elif line.startswith('(') and line.endswith(')'):  # Parentheticals
-                actionable_lines.append(line)
-            elif len(line) < 80 and not line.startswith('Here') and not line.startswith('I '):  # Short action lines
-                actionable_lines.append(line)
+        actionable_lines = [line for line in lines if _is_script_line(line)]
         
         # If we found actionable content, return it
         if actionable_lines:
@@ -538,11 +831,7 @@ class AIAssistantPanel(wx.Panel):
         
         # If no specific content found, return the first non-empty line that's not an explanation
         for line in lines:
-            line = line.strip()
-            if line and len(line) < 100 and not any(skip_word in line.lower() for skip_word in [
-                'here\'s', 'here is', 'i suggest', 'you could', 'consider', 
-                'try this', 'example', 'suggestion', 'note:', 'tip:', 'advice:'
-            ]):
+            if len(line) < 100 and not _FALLBACK_SKIP_RE.search(line):
                 return line
         
         return content  # Fallback to original content if nothing else works
@@ -556,40 +845,27 @@ class AIAssistantPanel(wx.Panel):
         
         try:
             # Determine the line type based on selection
-            line_types = {
-                0: screenplay.ACTION,      # Action Line
-                1: screenplay.SCENE,       # Scene Heading
-                2: screenplay.CHARACTER,   # Character Name
-                3: screenplay.DIALOGUE,    # Dialogue
-                4: screenplay.PAREN        # Parenthetical
-            }
-            
-            target_type = line_types.get(insert_type, screenplay.ACTION)
+            if 0 <= insert_type < len(_INSERT_LINE_TYPES):
+                target_type = _INSERT_LINE_TYPES[insert_type]
+            else:
+                target_type = screenplay.ACTION
             
             # Clean up the content for insertion
             cleaned_content = self.clean_content_for_insertion(content, target_type)
             
-            # Split content into lines if it contains newlines
-            content_lines = cleaned_content.split('\n')
+            # Split content into its non-empty lines, or one empty line if
+            # there are none
+            parts = [p for p in (l.strip() for l in cleaned_content.split('\n')) if p] or [""]
             
-            # Create Line objects for each line
+            # Create Line objects for each line. The last one ends the
+            # element, the others are forced line breaks within it.
             from trelby.line import Line
-            new_lines = []
-            
-            for i, line_content in enumerate(content_lines):
-                if line_content.strip():  # Only add non-empty lines
-                    # Set line break type: LB_LAST for last line, LB_FORCED for others
-                    lb_type = screenplay.LB_LAST if i == len(content_lines) - 1 else screenplay.LB_FORCED
-                    new_line = Line(lb_type, target_type, line_content.strip())
-                    new_lines.append(new_line)
-            
-            # If no valid lines, create one empty line
-            if not new_lines:
-                new_lines = [Line(screenplay.LB_LAST, target_type, "")]
+            last = len(parts) - 1
+            new_lines = [Line(screenplay.LB_LAST if i == last else screenplay.LB_FORCED,
+                              target_type, p) for i, p in enumerate(parts)]
             
             # Append all new lines to the end of the screenplay
-            for new_line in new_lines:
-                sp.lines.append(new_line)
+            sp.lines.extend(new_lines)
             
             # Move cursor to the last new line
             sp.line = len(sp.lines) - 1
@@ -604,7 +880,7 @@ class AIAssistantPanel(wx.Panel):
                     if hasattr(self.gd.mainFrame.panel, 'ctrl') and self.gd.mainFrame.panel.ctrl:
                         self.gd.mainFrame.panel.ctrl.Refresh()
             
-            wx.MessageBox(f"Content added to script as {['Action Line', 'Scene Heading', 'Character Name', 'Dialogue', 'Parenthetical'][insert_type]}", 
+            wx.MessageBox(f"Content added to script as {_INSERT_LINE_TYPE_NAMES[_INSERT_LINE_TYPES.index(target_type)]}", 
                          "Success", wx.OK | wx.ICON_INFORMATION)
             
         except Exception as e:
@@ -620,41 +896,24 @@ class AIAssistantPanel(wx.Panel):
             content = content[1:-1]
         
         # Remove AI assistant prefixes
-        prefixes_to_remove = [
-            "AI Assistant: ",
-            "Here's a ",
-            "Here is a ",
-            "I suggest ",
-            "You could write ",
-            "Consider adding ",
-            "Try this: ",
-            "Here's an example: ",
-            "Example: ",
-            "Suggestion: "
-        ]
-        
-        for prefix in prefixes_to_remove:
-            if content.startswith(prefix):
-                content = content[len(prefix):].strip()
+        content = _AI_PREFIXES_RE.sub("", content, count=1).strip()
         
         # Format based on line type
         if line_type == screenplay.SCENE:
             # Ensure scene headings are in proper format
-            if not content.upper() == content:
-                content = content.upper()
+            content = content.upper()
             if not content.startswith(('INT.', 'EXT.', 'INT/EXT.')):
                 # Try to detect if it should be INT or EXT
-                if any(word in content.lower() for word in ['inside', 'interior', 'room', 'house', 'building', 'office']):
+                if _INT_WORDS_RE.search(content):
                     content = f"INT. {content}"
-                elif any(word in content.lower() for word in ['outside', 'exterior', 'street', 'park', 'forest', 'beach']):
+                elif _EXT_WORDS_RE.search(content):
                     content = f"EXT. {content}"
                 else:
                     content = f"INT. {content}"  # Default to INT
         
         elif line_type == screenplay.CHARACTER:
             # Ensure character names are in proper format
-            if not content.upper() == content:
-                content = content.upper()
+            content = content.upper()
         
         elif line_type == screenplay.PAREN:
             # Ensure parentheticals are properly formatted
@@ -675,24 +934,72 @@ class AIAssistantPanel(wx.Panel):
         # Clear input
         self.input_text.SetValue("")
         
-        # Disable send button while processing
-        self.send_button.Disable()
-        self.send_button.SetLabel("Thinking...")
+        # If a response is still on its way (Enter works even while the
+        # button is disabled), queue the message; everything queued is sent
+        # together in one request once the current one finishes
+        if self.request_in_flight:
+            self.pending_messages.append(message)
+            return
         
         # Get AI response
-        if self.ai_service:
-            # Run AI call in background thread
-            thread = threading.Thread(target=self.get_ai_response, args=(message,))
-            thread.daemon = True
-            thread.start()
+        if self.ensure_ai_service():
+            self.start_ai_request(message)
         else:
             self.add_message("AI Assistant", "AI service is not available. Please check your configuration.", is_user=False)
-            self.send_button.Enable()
-            self.send_button.SetLabel("Send")
     
-    def get_ai_response(self, user_message):
+    def add_to_summary(self, msg):
+        """Add a message that no longer fits in the send window to the summary of older messages"""
+        text = " ".join(msg['message'].split())
+        if len(text) > MAX_SUMMARY_MESSAGE_LENGTH:
+            text = text[:MAX_SUMMARY_MESSAGE_LENGTH] + "..."
+        
+        sender = "User" if msg['is_user'] else "AI"
+        summary = f"{self._rolling_summary}\n{sender}: {text}" if self._rolling_summary else f"{sender}: {text}"
+        
+        # Drop the oldest messages once the summary gets too long
+        if len(summary) > MAX_SUMMARY_LENGTH:
+            start = summary.find("\n", len(summary) - MAX_SUMMARY_LENGTH)
+            summary = summary[start + 1:] if start != -1 else summary[-MAX_SUMMARY_LENGTH:]
+        
+        self._rolling_summary = summary
+    
+    def get_send_history(self):
+        """Get the conversation history to send to the AI service (main thread)"""
+        history = list(self._send_window)
+        
+        if self._rolling_summary:
+            history.insert(0, {
+                'sender': "Summary",
+                'message': f"Summary of the earlier conversation:\n{self._rolling_summary}",
+                'is_user': True,
+                'timestamp': history[0]['timestamp']
+            })
+        
+        return history
+    
+    def start_ai_request(self, message):
+        """Start getting the AI response for message in a background thread"""
+        self.request_in_flight = True
+        
+        # Disable send button while processing
+        self.send_button.Disable()
+        self.send_button.SetLabel("Thinking...")
+        
+        # Run AI call in background thread
+        self._req_q.put((message, self.get_send_history(), self.current_image))
+    
+    def ai_worker_loop(self):
+        """Handle queued AI requests (background thread)"""
+        while True:
+            message, conversation_history, image = self._req_q.get()
+            self.get_ai_response(message, conversation_history, image)
+    
+    def get_ai_response(self, user_message, conversation_history, image=None):
         """Get response from Claude in background thread with semantic search"""
+        streaming = False
         try:
+            self.ensure_embedding_services()
+            
             # Check if screenplay has changed and update embeddings if needed
             print("Debug: Checking if screenplay needs embedding update...")
             self.ensure_embeddings_up_to_date()
@@ -707,49 +1014,134 @@ class AIAssistantPanel(wx.Panel):
             # Get basic document context
             basic_context = self.get_basic_context()
             
-            # Combine contexts
+            # Answer a repeated question from the cache without asking the
+            # service again, if neither the screenplay, the context around
+            # the cursor nor the conversation before the question has
+            # changed since. Questions about an image are always sent.
+            cache_key = (self.current_service, self.ai_service.model)
+            ctx_hash = None
+            if image is None:
+                ctx_hash = self.get_response_cache_hash(basic_context, conversation_history, user_message)
+                cached = self.response_cache.get(cache_key, ctx_hash, user_message)
+                if cached is not None:
+                    print("Debug: Using cached response")
+                    wx.CallAfter(self.handle_ai_response, cached)
+                    return
+            
+            # The basic context is sent as the context, which the service puts
+            # after the cacheable part of the prompt. The semantic search
+            # results depend on the message and are sent along with it.
             if semantic_context:
-                combined_context = f"{basic_context}\n\n{semantic_context}"
+                request_message = f"{user_message}\n\n{semantic_context}"
             else:
-                combined_context = basic_context
-            
-            # Get conversation history
-            conversation_history = self.chat_history.copy()
+                request_message = user_message
             
-            # Debug logging
             print(f"Debug: Sending conversation with {len(conversation_history)} previous messages")
-            if conversation_history:
-                recent_messages = conversation_history[-6:]  # Last 6 messages
-                print(f"Debug: Recent conversation:")
-                for msg in recent_messages:
-                    sender = "User" if msg['is_user'] else "AI"
-                    preview = msg['message'][:50] + "..." if len(msg['message']) > 50 else msg['message']
-                    print(f"  {sender}: {preview}")
             
-            # Get AI response with combined context
-            # Pass the current AI service to use the correct model
-            response = self.embedding_ai_service.get_response(user_message, combined_context, conversation_history, self.ai_service)
+            # Stream the AI response into the chat as it is generated.
+            # Pass the current AI service to use the correct model.
+            chunks = self.embedding_ai_service.get_response_stream(request_message, basic_context, conversation_history, self.ai_service, image)
             
             # Update UI in main thread
-            wx.CallAfter(self.handle_ai_response, response)
+            # Pass the pieces on to the GUI thread a few at a time rather
+            # than one token at a time
+            from trelby.ai.streaming import StreamError, coalesce
+            wx.CallAfter(self.begin_streamed_message, "AI Assistant")
+            streaming = True
+            parts = []
+            failed = False
+            for chunk in coalesce(chunks):
+                failed = failed or isinstance(chunk, StreamError)
+                parts.append(chunk)
+                wx.CallAfter(self.append_stream_chunk, chunk)
+            streaming = False
+            wx.CallAfter(self.finish_streamed_message)
+            
+            # Services report errors as the end of the response text, don't
+            # keep those
+            if ctx_hash is not None and not failed:
+                self.response_cache.set(cache_key, ctx_hash, user_message, "".join(parts))
         except Exception as e:
             error_msg = f"Error getting AI response: {str(e)}"
-            wx.CallAfter(self.handle_ai_response, error_msg)
+            if streaming:
+                wx.CallAfter(self.finish_streamed_message, error_msg)
+            else:
+                wx.CallAfter(self.handle_ai_response, error_msg)
+    
+    def get_response_cache_hash(self, basic_context, conversation_history, user_message):
+        """Get the hash of everything a cached response depends on besides the question"""
+        from trelby.ai.responsecache import conversation_hash
+        
+        # The hash of the whole screenplay is only calculated again once it
+        # has been edited
+        screenplay_hash = None
+        screenplay = self.get_current_screenplay()
+        if screenplay:
+            if self._last_hash_check == (screenplay, screenplay.rev):
+                screenplay_hash = self.current_screenplay_hash
+            else:
+                screenplay_hash = self.get_screenplay_hash(screenplay)
+        
+        return conversation_hash(screenplay_hash, basic_context, conversation_history, user_message)
     
     def handle_ai_response(self, response):
         """Handle AI response in main thread"""
         # Always show as regular message (insertion feature removed)
         self.add_message("AI Assistant", response, is_user=False)
-
+        self.response_finished()
+    
+    def begin_streamed_message(self, sender):
+        """Start showing a message whose text arrives in pieces (main thread)"""
+        self.stream_sender = sender
+        self.stream_parts = []
+        self.stream_start = self.chat_display.GetLastPosition()
+        self.chat_display.AppendText(f"{sender}: ")
+    
+    def append_stream_chunk(self, chunk):
+        """Show the next piece of a streamed message (main thread)"""
+        self.stream_parts.append(chunk)
+        self.chat_display.AppendText(chunk)
+    
+    def finish_streamed_message(self, error_msg=None):
+        """Finish a streamed message and store it in history (main thread)"""
+        self.chat_display.AppendText("\n\n")
+        self.message_displayed(self.stream_start)
+        self.store_message(self.stream_sender, "".join(self.stream_parts), is_user=False)
+        self.stream_sender = None
+        self.stream_parts = []
+        
+        # Show the messages that came in meanwhile
+        deferred, self.deferred_messages = self.deferred_messages, []
+        for sender, message, is_user in deferred:
+            self.add_message(sender, message, is_user)
+        
+        if error_msg:
+            self.add_message("AI Assistant", error_msg, is_user=False)
+        
+        self.response_finished()
+    
+    def response_finished(self):
+        """Send queued messages or re-enable sending after a response (main thread)"""
+        # Send messages that were queued meanwhile as a single request
+        if self.pending_messages and self.ai_service:
+            message = "\n\n".join(self.pending_messages)
+            self.pending_messages = []
+            self.start_ai_request(message)
+            return
+        
+        self.pending_messages = []
+        self.request_in_flight = False
         self.send_button.Enable()
         self.send_button.SetLabel("Send")
     
     def add_selected_text_to_chat(self):
         """Add selected text to the chat input field"""
-        selected_text = self.get_selected_text()
-        if selected_text:
+        selected = self.get_selected_preview(100)
+        if selected:
             # Truncate for display if too long
-            preview = selected_text[:100] + "..." if len(selected_text) > 100 else selected_text
+            preview, length = selected
+            if length > 100:
+                preview += "..."
             current_input = self.input_text.GetValue()
             
             if current_input:
@@ -762,7 +1154,7 @@ class AIAssistantPanel(wx.Panel):
             self.input_text.SetFocus()
             
             # Show a brief message in chat
-            self.add_message("System", f"Added selected text to input ({len(selected_text)} characters)", is_user=False)
+            self.add_message("System", f"Added selected text to input ({length} characters)", is_user=False)
         else:
             # Show error message
             self.add_message("System", "No text selected. Please select some text first.", is_user=False)
@@ -798,39 +1190,47 @@ class AIAssistantPanel(wx.Panel):
         if not sp:
             return "No screenplay loaded."
         
+        key = (sp, sp.rev, sp.line)
+        if self._ctx_cache[0] == key:
+            return self._ctx_cache[1]
+        
         context_parts = []
         
         # Basic script info
         context_parts.append(f"SCRIPT INFO:")
         context_parts.append(f"- Total lines: {len(sp.lines)}")
-        context_parts.append(f"- Characters: {len(sp.getCharacterNames())}")
+        characters = sp.getCharacterNames()
+        context_parts.append(f"- Characters: {len(characters)}")
         context_parts.append(f"- Scenes: {len(sp.getSceneLocations())}")
         context_parts.append(f"- Current page: {sp.line2page(sp.line) if sp.line < len(sp.lines) else 'N/A'}")
         
         # Character list
-        characters = list(sp.getCharacterNames().keys())
         if characters:
             context_parts.append(f"\nCHARACTERS:")
-            context_parts.append(", ".join(characters[:10]))  # Limit to first 10
+            context_parts.append(", ".join(itertools.islice(characters, 10)))  # Limit to first 10
             if len(characters) > 10:
                 context_parts.append(f"... and {len(characters) - 10} more")
         
         # Current scene context
         try:
-            current_scene_start, current_scene_end = sp.getSceneIndexesFromLine(sp.line)
+            current_scene_start = sp.getSceneIndexesFromLine(sp.line)[0]
+            
+            # A scene heading can only be the scene's first element, so
+            # only that needs to be looked at, not the whole scene
+            heading_end = sp.getElemLastIndexFromLine(current_scene_start)
             current_scene_text = ""
-            for i in range(current_scene_start, min(current_scene_end + 1, len(sp.lines))):
-                line = sp.lines[i]
-                if line.lt == screenplay.SCENE and line.lb == screenplay.LB_LAST:
-                    current_scene_text = line.text
-                    break
+            if sp.lines[heading_end].lt == screenplay.SCENE:
+                current_scene_text = sp.lines[heading_end].text
             
             if current_scene_text:
                 context_parts.append(f"\nCURRENT SCENE: {current_scene_text}")
         except:
             pass
         
-        return "\n".join(context_parts)
+        context = "\n".join(context_parts)
+        self._ctx_cache = (key, context)
+        
+        return context
     
     def get_screenplay_context(self, user_message):
         """Get context from the current screenplay based on user query (legacy method)"""
@@ -839,35 +1239,29 @@ class AIAssistantPanel(wx.Panel):
             return "No screenplay loaded."
         
         # Check if user message contains selected text (added via menu)
-        if "Selected text:" in user_message:
-            # Extract the selected text from the message
-            lines = user_message.split('\n')
-            selected_text = ""
-            in_selected_section = False
-            
-            for line in lines:
-                if line.strip() == "Selected text:":
-                    in_selected_section = True
-                    continue
-                elif in_selected_section and line.strip() == "":
-                    break
-                elif in_selected_section:
-                    selected_text += line + "\n"
+        _, sep, rest = user_message.partition("Selected text:\n")
+        if sep:
+            # The selected text runs up to the first blank line
+            selected_text = _BLANK_LINE_RE.split(rest, 1)[0]
             
             if selected_text.strip():
-                context_parts = []
-                context_parts.append("SELECTED TEXT:")
-                context_parts.append(selected_text.strip())
-                context_parts.append("\n" + "="*50 + "\n")
+                # Write the context straight into one buffer instead of
+                # collecting the pieces in a list and joining them
+                buf = io.StringIO()
+                w = buf.write
+                
+                w("SELECTED TEXT:\n")
+                w(selected_text.strip())
+                w("\n\n" + "="*50 + "\n\n")
                 
                 # Add basic script info for context
-                context_parts.append("SCRIPT INFO:")
-                context_parts.append(f"- Total lines: {len(sp.lines)}")
-                context_parts.append(f"- Characters: {len(sp.getCharacterNames())}")
-                context_parts.append(f"- Scenes: {len(sp.getSceneLocations())}")
-                context_parts.append(f"- Current page: {sp.line2page(sp.line) if sp.line < len(sp.lines) else 'N/A'}")
+                w("SCRIPT INFO:\n")
+                w(f"- Total lines: {len(sp.lines)}\n")
+                w(f"- Characters: {len(sp.getCharacterNames())}\n")
+                w(f"- Scenes: {len(sp.getSceneLocations())}\n")
+                w(f"- Current page: {sp.line2page(sp.line) if sp.line < len(sp.lines) else 'N/A'}")
                 
-                return "\n".join(context_parts)
+                return buf.getvalue()
         
         # Fall back to basic context
         return self.get_basic_context()
@@ -897,13 +1291,46 @@ class AIAssistantPanel(wx.Panel):
         
         return None
     
+    def get_selected_preview(self, max_chars):
+        """
+        Get the first max_chars characters of the currently selected text
+        and the length of the whole text, as get_selected_text would return
+        it, without joining all of a long selection. Returns None if no text
+        is selected.
+        """
+        sp = self.get_current_screenplay()
+        if not sp:
+            return None
+        
+        cd = sp.getSelectedAsCD(False)
+        if not cd or not cd.lines:
+            return None
+        
+        if not any(line.text.strip() for line in cd.lines):
+            return None
+        
+        # Lines are joined with line breaks, one less than there are lines
+        length = len(cd.lines) - 1
+        parts = []
+        preview_length = 0
+        for line in cd.lines:
+            length += len(line.text)
+            if preview_length < max_chars:
+                parts.append(line.text)
+                preview_length += len(line.text) + 1
+        
+        return "\n".join(parts)[:max_chars], length
+    
     def clear_conversation_history(self):
         """Clear the conversation history"""
-        self.chat_history = []
-        self.chat_display.SetValue("")
+        self.chat_history.clear()
+        self._send_window.clear()
+        self._rolling_summary = ""
+        self.chat_display.Clear()
+        self._displayed_lengths.clear()
         
         # Add welcome message back
-        if self.ai_service:
+        if self.ai_available:
             welcome_msg = "Conversation cleared. I'm ready to help you with your screenplay!"
         else:
             welcome_msg = "Conversation cleared. AI service is not available."
@@ -920,22 +1347,19 @@ class AIAssistantPanel(wx.Panel):
         
         # Basic stats
         total_lines = len(sp.lines)
-        characters = list(sp.getCharacterNames().keys())
+        characters = sp.getCharacterNames()
         scenes = sp.getSceneLocations()
         
         analysis += f"• Total lines: {total_lines}\n"
-        analysis += f"• Characters: {len(characters)} ({', '.join(characters[:5])}{'...' if len(characters) > 5 else ''})\n"
+        analysis += f"• Characters: {len(characters)} ({', '.join(itertools.islice(characters, 5))}{'...' if len(characters) > 5 else ''})\n"
         analysis += f"• Scenes: {len(scenes)}\n"
         
-        # Element breakdown
-        element_counts = {}
-        for line in sp.lines:
-            element_type = line.lt
-            element_counts[element_type] = element_counts.get(element_type, 0) + 1
+        # Element breakdown, only counted again after the screenplay changed
+        element_counts = sp.getTypeCounts()
         
-        analysis += f"• Action lines: {element_counts.get(sp.ACTION, 0)}\n"
-        analysis += f"• Dialogue lines: {element_counts.get(sp.DIALOGUE, 0)}\n"
-        analysis += f"• Scene headings: {element_counts.get(sp.SCENE, 0)}\n"
+        analysis += f"• Action lines: {element_counts[screenplay.ACTION]}\n"
+        analysis += f"• Dialogue lines: {element_counts[screenplay.DIALOGUE]}\n"
+        analysis += f"• Scene headings: {element_counts[screenplay.SCENE]}\n"
         
         # Embedding status
         if self.embeddings_initialized and self.embedding_ai_service:
@@ -950,7 +1374,7 @@ class AIAssistantPanel(wx.Panel):
             analysis += "• Consider adding more characters for richer interactions\n"
         if len(scenes) < 5:
             analysis += "• You might want to develop more scenes for a complete story\n"
-        if element_counts.get(screenplay.ACTION, 0) < element_counts.get(screenplay.DIALOGUE, 0):
+        if element_counts[screenplay.ACTION] < element_counts[screenplay.DIALOGUE]:
             analysis += "• Good balance between action and dialogue\n"
         else:
             analysis += "• Consider adding more dialogue to balance the action-heavy content\n"
@@ -964,22 +1388,24 @@ class AIAssistantPanel(wx.Panel):
                 print("Debug: Screenplay has no lines attribute")
                 return None
             
-            # Use the first 1000 characters and total line count as a simple hash
-            content = ""
+            # Hash the type, line break and text of every line, so that an
+            # edit anywhere in the script is noticed. Unlike hash(), the
+            # digest is the same in every run, so it can identify the script
+            # on disk. The lines are separated by NUL so that the same text
+            # split into lines differently hashes differently. This is only
+            # done once the script has changed, see
+            # ensure_embeddings_up_to_date, and blake2b hashes even a long
+            # script in about a millisecond.
             line_count = len(screenplay.lines)
             
-            for i, line in enumerate(screenplay.lines):
-                if i < 50:  # First 50 lines
-                    content += line.text
-                if len(content) > 1000:
-                    break
+            content = "\x00".join([f"{line.lt}{line.lb}{line.text}" for line in screenplay.lines])
+            length = len(content)
             
-            hash_input = content + str(line_count)
-            hash_result = hash(hash_input)
+            hash_result = hashlib.blake2b(content.encode('utf-8', 'ignore'), digest_size=16).hexdigest()
             
             # Only log hash details when there's a significant change
-            if not hasattr(self, '_last_hash_log') or self._last_hash_log != hash_result:
-                print(f"Debug: Hash calculation - {line_count} lines, {len(content)} chars, hash: {hash_result}")
+            if self._last_hash_log != hash_result:
+                print(f"Debug: Hash calculation - {line_count} lines, {length} chars, hash: {hash_result}")
                 self._last_hash_log = hash_result
             
             return hash_result
@@ -996,6 +1422,12 @@ class AIAssistantPanel(wx.Panel):
                 print("Debug: No screenplay available for embedding update")
                 return False
             
+            # Nothing to hash again if the screenplay hasn't been edited
+            # since the last check
+            check_key = (screenplay, screenplay.rev)
+            if self.embeddings_initialized and check_key == self._last_hash_check:
+                return True
+            
             # Calculate current hash
             current_hash = self.get_screenplay_hash(screenplay)
             if current_hash is None:
@@ -1005,6 +1437,7 @@ class AIAssistantPanel(wx.Panel):
             # Check if screenplay has changed
             if current_hash == self.current_screenplay_hash:
                 print("Debug: Screenplay unchanged, embeddings are up to date")
+                self._last_hash_check = check_key
                 # Update embedding AI service hash to maintain cache consistency
                 if self.embedding_ai_service:
                     self.embedding_ai_service.update_screenplay_hash(current_hash)
@@ -1014,10 +1447,38 @@ class AIAssistantPanel(wx.Panel):
             print(f"Debug: Old hash: {self.current_screenplay_hash}")
             print(f"Debug: New hash: {current_hash}")
             
-            # Update embeddings
-            success = self.process_screenplay_embeddings_sync(screenplay)
+            if not self.embedding_ai_service:
+                print("Debug: No embedding AI service available")
+                return False
+            
+            # Each version of a script has its own collection, which is kept
+            # on disk, so reopening an unchanged script reuses the embeddings
+            # made in an earlier session
+            old_collection = self.embedding_ai_service.collection_name
+            replaces_old = (screenplay is self.embedded_screenplay) and (self.current_screenplay_hash is not None)
+            
+            if self.embedding_ai_service.use_collection(f"screenplay_{current_hash}") > 0:
+                print("Debug: Reusing stored embeddings for this screenplay")
+                info = self.embedding_ai_service.get_collection_info()
+                self.embeddings_initialized = True
+                self.update_status(f"✓ Semantic search ready ({info['document_count']} scenes analyzed)")
+                success = True
+            else:
+                # Update embeddings
+                success = self.process_screenplay_embeddings_sync(screenplay)
+            
             if success:
+                # The embeddings of the script's previous version are no
+                # longer needed
+                if replaces_old:
+                    self.embedding_ai_service.delete_collection(old_collection)
+                
+                # Nor are those of scripts that haven't been used for long
+                self.embedding_ai_service.prune_collections("screenplay_")
+                
+                self.embedded_screenplay = screenplay
                 self.current_screenplay_hash = current_hash
+                self._last_hash_check = check_key
                 # Update embedding AI service hash to maintain cache consistency
                 if self.embedding_ai_service:
                     self.embedding_ai_service.update_screenplay_hash(current_hash)
@@ -1062,10 +1523,12 @@ class AIAssistantPanel(wx.Panel):
                 print(f"Debug: Setting status: {status_msg}")
                 self.update_status(status_msg)
                 
-                # Add a helpful message to the chat
+                # Add a helpful message to the chat. This runs in the
+                # background thread, and the chat can only be changed from
+                # the main thread.
                 chat_msg = f"Screenplay updated! I can now help you with character development, plot analysis, scene structure, and finding patterns in your {info['document_count']} scenes."
                 print(f"Debug: Adding chat message: {chat_msg}")
-                self.add_message("System", chat_msg, is_user=False)
+                wx.CallAfter(self.add_message, "System", chat_msg, is_user=False)
                 return True
             else:
                 print("Debug: Embedding storage failed, setting error status")
@@ -1,8 +1,110 @@
 # -*- coding: utf-8 -*-
 
 import wx
+import queue
+import re
 import threading
-from trelby.screenplay_formatter import fix_formatting
+from trelby.ai.responsecache import ResponseCache, context_hash
+from trelby.ai.streaming import StreamError, coalesce
+from trelby.screenplay_formatter import convert_to_lines, fix_formatting
+
+# Rewrites of recently rewritten texts, shared by all rewrite dialogs, so
+# that asking for the same rewrite of the same text again is answered
+# without another request. Instructions only count as the same when they
+# differ in nothing but case, whitespace and punctuation, as any other
+# change in them matters here.
+_rewrite_cache = ResponseCache()
+
+# Instructions used when the user gives none
+_DEFAULT_INSTRUCTIONS = "Improve clarity, flow, and impact while maintaining proper screenplay formatting."
+
+# Prompt for rewriting a text, filled in with the instructions and the text
+_REWRITE_PROMPT = """You are an expert screenplay rewriter and formatter.
+Rewrite the following text based on the user's instructions.
+Then, format the result using Fountain markup.
+
+Fountain formatting rules:
+- Scene headings: Start with # (e.g., "# INT. ROOM - DAY")
+- Character names: Start with @ (e.g., "@JOHN")
+- Dialogue: Regular text after character name (no special markup)
+- Parentheticals: In parentheses (e.g., "(whispering)")
+- Transitions: Start with > (e.g., "> FADE OUT")
+- Action: Regular text (no special markup)
+- Notes: Between /* and */ (e.g., "/* This is a note */")
+
+IMPORTANT FORMATTING GUIDELINES:
+1. Scene headings should be in ALL CAPS: INT./EXT. LOCATION - TIME
+2. Character names should be in ALL CAPS
+3. Transitions should be in ALL CAPS
+4. Dialogue should follow character names without any special markup
+5. Parentheticals should be on their own line after character names
+6. Action lines should be regular text with no markup
+7. Maintain proper screenplay structure and flow
+
+User instructions: "{instructions}"
+
+Original text to rewrite:
+{original_text}
+
+Return ONLY the rewritten, Fountain-formatted screenplay content. No commentary or explanations."""
+
+# A line starting with Fountain markup for a scene heading, character or
+# transition
+_FOUNTAIN_MARKUP_RE = re.compile(r"^[#@>]", re.MULTILINE)
+
+# Rewrite requests of all dialogs are handled one at a time by a single
+# background thread, started on first use
+_request_queue = queue.Queue()
+_worker = None
+
+def _worker_loop():
+    """Handle queued rewrite requests (background thread)"""
+    while True:
+        request = _request_queue.get()
+        request()
+
+def _run_in_background(request):
+    """Queue a function to be called in the rewrite worker thread"""
+    global _worker
+    
+    if _worker is None:
+        _worker = threading.Thread(target=_worker_loop, daemon=True)
+        _worker.start()
+    
+    _request_queue.put(request)
+
+def _selected_texts(ctrl):
+    """Get the (type, text) of each selected line of a screenplay control"""
+    cd = ctrl.sp.getSelectedAsCD(False)
+    if not cd:
+        return None
+    return [(ln.lt, ln.text) for ln in cd.lines]
+
+def _replace_selection(ctrl, selected, lines):
+    """
+    Replace the selection of a screenplay control with lines, as a single
+    undoable edit, if it is still the one that was rewritten (GUI thread)
+    """
+    # The window may have been closed while the rewrite was formatted
+    if not ctrl:
+        return
+    
+    if not lines:
+        _show_error("The rewrite could not be formatted. The original text was kept.")
+        return
+    
+    if _selected_texts(ctrl) != selected:
+        _show_error("The selection changed while the rewrite was formatted. "
+                    "The original text was kept.")
+        return
+    
+    ctrl.sp.replaceSelected(lines)
+    ctrl.makeLineVisible(ctrl.sp.line)
+    ctrl.updateScreen()
+
+def _show_error(message):
+    """Tell the user that accepting a rewrite failed (GUI thread)"""
+    wx.MessageBox(message, "Error", wx.OK | wx.ICON_ERROR)
 
 class AIRewrite(wx.Dialog):
     """Dialog for AI text rewriting with accept/reject functionality"""
@@ -10,10 +112,19 @@ class AIRewrite(wx.Dialog):
     def __init__(self, parent, ai_service, original_text):
         wx.Dialog.__init__(self, parent, -1, "AI Rewrite", size=(700, 500))
         
-        self.original_text = original_text
+        # Trailing whitespace of the selection would only end up in the prompt
+        self.original_text = original_text.rstrip()
         self.ai_service = ai_service
         self.ai_suggestion = ""
         
+        # Lines of the suggestion, if already converted from Fountain markup
+        self.suggestion_lines = None
+        
+        # Whether a suggestion is being generated, and the number of the
+        # latest request; results of any earlier ones are dropped
+        self.generating = False
+        self.generation = 0
+        
         self.init_ui()
         
         # Don't start AI rewrite automatically - wait for user instructions
@@ -92,10 +203,13 @@ class AIRewrite(wx.Dialog):
     def OnInstructionsChanged(self, event):
         """Enable generate button when instructions are provided"""
         instructions = self.instructions_text.GetValue().strip()
-        self.generate_button.Enable(bool(instructions))
+        
+        # The buttons stay disabled until the suggestion being generated
+        # has arrived
+        self.generate_button.Enable(bool(instructions) and not self.generating)
         
         # Enable regenerate button if we have both instructions and a suggestion
-        if instructions and self.ai_suggestion:
+        if instructions and self.ai_suggestion and not self.generating:
             self.regenerate_button.Enable()
         else:
             self.regenerate_button.Disable()
@@ -124,9 +238,12 @@ class AIRewrite(wx.Dialog):
     def OnRegenerate(self, event):
         """Regenerate AI suggestion with new instructions"""
         self.suggestion_text_ctrl.SetValue("Generating new suggestion...")
+        self.generate_button.Disable()
         self.accept_button.Disable()
         self.regenerate_button.Disable()
-        self.get_ai_rewrite()
+        
+        # The user wants a different suggestion, not the cached one
+        self.get_ai_rewrite(use_cache=False)
     
     def OnAccept(self, event):
         """Accept the AI suggestion and replace the text"""
@@ -134,61 +251,90 @@ class AIRewrite(wx.Dialog):
             self.replace_selected_text(self.ai_suggestion)
         event.Skip()
     
-    def get_ai_rewrite(self):
+    def get_ai_rewrite(self, use_cache=True):
         """Get AI rewrite suggestion in background thread"""
+        # Get user instructions
+        instructions = self.instructions_text.GetValue().strip() or _DEFAULT_INSTRUCTIONS
+        
+        cache_key = (type(self.ai_service).__name__, getattr(self.ai_service, 'model', None))
+        text_hash = context_hash(self.original_text)
+        
+        self.generating = True
+        self.generation += 1
+        generation = self.generation
+        
+        if use_cache:
+            cached = _rewrite_cache.get(cache_key, text_hash, instructions)
+            if cached is not None:
+                self.update_suggestion(cached, None, generation)
+                return
+        
         def ai_thread():
             try:
-                # Get user instructions
-                instructions = self.instructions_text.GetValue().strip()
-                
                 # Create a more specific and reliable prompt for screenplay rewriting
-                prompt = f"""You are an expert screenplay rewriter and formatter.
-Rewrite the following text based on the user's instructions.
-Then, format the result using Fountain markup.
-
-Fountain formatting rules:
-- Scene headings: Start with # (e.g., "# INT. ROOM - DAY")
-- Character names: Start with @ (e.g., "@JOHN")
-- Dialogue: Regular text after character name (no special markup)
-- Parentheticals: In parentheses (e.g., "(whispering)")
-- Transitions: Start with > (e.g., "> FADE OUT")
-- Action: Regular text (no special markup)
-- Notes: Between /* and */ (e.g., "/* This is a note */")
-
-IMPORTANT FORMATTING GUIDELINES:
-1. Scene headings should be in ALL CAPS: INT./EXT. LOCATION - TIME
-2. Character names should be in ALL CAPS
-3. Transitions should be in ALL CAPS
-4. Dialogue should follow character names without any special markup
-5. Parentheticals should be on their own line after character names
-6. Action lines should be regular text with no markup
-7. Maintain proper screenplay structure and flow
-
-User instructions: "{instructions if instructions else 'Improve clarity, flow, and impact while maintaining proper screenplay formatting.'}"
-
-Original text to rewrite:
-{self.original_text}
-
-Return ONLY the rewritten, Fountain-formatted screenplay content. No commentary or explanations."""
+                prompt = _REWRITE_PROMPT.format(
+                    instructions=instructions,
+                    original_text=self.original_text)
                 
-                # Get AI response
-                response = self.ai_service.get_simple_response(prompt, self.ai_service)
+                # Show the AI response as it is generated instead of only
+                # once all of it has arrived, a few pieces at a time
+                parts = []
+                failed = False
+                for chunk in coalesce(self.ai_service.get_response_stream(prompt)):
+                    if not parts:
+                        wx.CallAfter(self.begin_suggestion, generation)
+                    failed = failed or isinstance(chunk, StreamError)
+                    parts.append(chunk)
+                    wx.CallAfter(self.append_suggestion_chunk, chunk, generation)
+                response = "".join(parts)
+                
+                # Services report errors as the end of the response text,
+                # don't keep those
+                if response and not failed:
+                    _rewrite_cache.set(cache_key, text_hash, instructions, response)
+                
+                # Convert the suggestion to lines here, while the user is
+                # still reading it, rather than on the GUI thread on accept
+                lines = None
+                if _FOUNTAIN_MARKUP_RE.search(response):
+                    lines = convert_to_lines(response)
                 
                 # Update UI on main thread
-                wx.CallAfter(self.update_suggestion, response)
+                wx.CallAfter(self.update_suggestion, response, lines, generation)
                 
             except Exception as e:
                 error_msg = f"Error getting AI suggestion: {str(e)}"
-                wx.CallAfter(self.update_suggestion, error_msg)
+                wx.CallAfter(self.update_suggestion, error_msg, None, generation)
         
-        # Start background thread
-        thread = threading.Thread(target=ai_thread)
-        thread.daemon = True
-        thread.start()
+        # Get the rewrite in the background
+        _run_in_background(ai_thread)
+    
+    def is_current(self, generation):
+        """Check if a result is for the latest request of a dialog that is still open"""
+        # The dialog may have been closed while the suggestion was made
+        return bool(self) and generation == self.generation
     
-    def update_suggestion(self, suggestion):
-        """Update the suggestion text and enable buttons"""
+    def begin_suggestion(self, generation):
+        """Clear the suggestion text for a suggestion about to be streamed"""
+        if self.is_current(generation):
+            self.suggestion_text_ctrl.Clear()
+    
+    def append_suggestion_chunk(self, chunk, generation):
+        """Append a piece of a streamed suggestion to the suggestion text"""
+        if self.is_current(generation):
+            self.suggestion_text_ctrl.AppendText(chunk)
+    
+    def update_suggestion(self, suggestion, lines, generation):
+        """
+        Update the suggestion text and enable buttons. lines are the
+        suggestion converted to lines, if that is already done.
+        """
+        if not self.is_current(generation):
+            return
+        
+        self.generating = False
         self.ai_suggestion = suggestion
+        self.suggestion_lines = lines
         self.suggestion_text_ctrl.SetValue(suggestion)
         self.accept_button.Enable()
         
@@ -206,20 +352,32 @@ Return ONLY the rewritten, Fountain-formatted screenplay content. No commentary
             # Get the current control from the parent frame
             current_ctrl = self.GetParent().panel.ctrl
             
-            # Get the current selection
-            cd = current_ctrl.sp.getSelectedAsCD(False)
-            if not cd:
+            # Get the current selection. It is kept until the rewrite is
+            # ready to replace it, so that nothing is lost if that fails.
+            selected = _selected_texts(current_ctrl)
+            if not selected:
                 return
             
-            # Use the existing cut functionality to delete selected text
-            current_ctrl.OnCut(doDelete=True, copyToClip=False)
-            
-            # Use intelligent formatting with AI service to create properly formatted lines
-            lines = fix_formatting(new_text, self.ai_service)
-            
-            # Use Trelby's paste functionality to insert the formatted text
-            if lines:
-                current_ctrl.sp.paste(lines)
+            # Rewrites are asked for in Fountain markup, and those that use
+            # it are converted right away. Only others need the AI service to
+            # format them, which is done in the background so the window
+            # doesn't freeze until it answers, and replace the selection
+            # once it has.
+            if new_text == self.ai_suggestion and self.suggestion_lines is not None:
+                _replace_selection(current_ctrl, selected, self.suggestion_lines)
+            elif _FOUNTAIN_MARKUP_RE.search(new_text):
+                _replace_selection(current_ctrl, selected, convert_to_lines(new_text))
+            else:
+                ai_service = self.ai_service
+                
+                def format_thread():
+                    try:
+                        lines = fix_formatting(new_text, ai_service)
+                        wx.CallAfter(_replace_selection, current_ctrl, selected, lines)
+                    except Exception as e:
+                        wx.CallAfter(_show_error, f"Error formatting rewrite: {str(e)}")
+                
+                _run_in_background(format_thread)
             
         except Exception as e:
             wx.MessageBox(
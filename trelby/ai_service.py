@@ -2,6 +2,7 @@
 
 import os
 import re
+import time
 import hashlib
 import anthropic
 import openai
@@ -10,6 +11,28 @@ from typing import List, Dict, Optional, Tuple
 from dotenv import load_dotenv
 import trelby.screenplay as screenplay_module
 from trelby.ai import get_ai_service
+from trelby.ai.anthropic import get_client
+from trelby.ai.ratelimit import get_rate_limiter
+from trelby.ai.embedcache import EmbeddingCache, chunk_hash
+from trelby.ai.streaming import error_stream
+
+# Maximum number of characters in the single chunk made for a screenplay
+# without scenes, so that it stays well within the embedding model's input
+# limit
+FALLBACK_CHUNK_LIMIT = 8000
+
+# Maximum number of texts embedded in a single request. The API limits the
+# number of inputs and their total length per request, so long scripts are
+# sent in several requests.
+EMBEDDING_BATCH_SIZE = 128
+
+# File the embeddings of screenplay chunks are cached in, next to the
+# ChromaDB database
+EMBEDDING_CACHE_PATH = "./chroma_db/embeddings.sqlite"
+
+# Number of screenplay collections kept on disk, the most recently used
+# ones, so that reopening a recent script doesn't embed it again
+MAX_STORED_COLLECTIONS = 10
 
 class AIService:
     """
@@ -38,6 +61,13 @@ class AIService:
         # Initialize ChromaDB
         self._init_chromadb(collection_name)
         
+        # Embeddings of unchanged chunks are reused from here instead of
+        # being created again
+        self._init_embedding_cache()
+        
+        # Shared with the other Claude clients so all requests are paced together
+        self.rate_limiter = get_rate_limiter("anthropic")
+        
         # Cache for system prompts and embeddings
         self.cached_system_prompt = None
         self.cached_semantic_context = None
@@ -62,7 +92,7 @@ class AIService:
                 raise ValueError("ANTHROPIC_API_KEY not found in environment variables")
             
             print(f"Debug: Anthropic API key found (length: {len(api_key)} chars)")
-            self.claude_client = anthropic.Anthropic(api_key=api_key)
+            self.claude_client = get_client(api_key)
             print("Debug: Claude client initialized successfully")
         except Exception as e:
             print(f"Debug: Failed to initialize Claude client: {e}")
@@ -218,13 +248,48 @@ class AIService:
             return []
         
         try:
-            print(f"Debug: Calling OpenAI embeddings API with model: {self.embedding_model}")
-            response = self.openai_client.embeddings.create(
-                input=texts,
-                model=self.embedding_model
-            )
-            embeddings = [embedding.embedding for embedding in response.data]
-            print(f"Debug: Successfully created {len(embeddings)} embeddings")
+            cached = {}
+            if self.embedding_cache:
+                cached = self.embedding_cache.get_many(self.embedding_model, texts)
+                print(f"Debug: Found {len(cached)} embeddings in cache")
+            
+            # Create the embeddings of all the missing texts in one request.
+            # Texts only slightly changed from a cached one, e.g. by a fixed
+            # typo, use the embedding of that one instead.
+            missing = []
+            for text in dict.fromkeys(texts):
+                key = chunk_hash(self.embedding_model, text)
+                if key in cached:
+                    continue
+                
+                similar = None
+                if self.embedding_cache:
+                    similar = self.embedding_cache.get_similar(self.embedding_model, text)
+                if similar is not None:
+                    cached[key] = similar
+                else:
+                    missing.append(text)
+            
+            print(f"Debug: {len(missing)} texts need new embeddings")
+            for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+                batch = missing[start:start + EMBEDDING_BATCH_SIZE]
+                print(f"Debug: Calling OpenAI embeddings API with model: {self.embedding_model}")
+                response = self.openai_client.embeddings.create(
+                    input=batch,
+                    model=self.embedding_model
+                )
+                created = [embedding.embedding for embedding in response.data]
+                print(f"Debug: Successfully created {len(created)} embeddings")
+                
+                # Cache each batch as soon as it is done, so that a failed
+                # later batch doesn't lose it
+                if self.embedding_cache:
+                    self.embedding_cache.set_many(self.embedding_model, batch, created)
+                
+                for text, embedding in zip(batch, created):
+                    cached[chunk_hash(self.embedding_model, text)] = embedding
+            
+            embeddings = [cached[chunk_hash(self.embedding_model, t)] for t in texts]
             if embeddings:
                 print(f"Debug: Each embedding has {len(embeddings[0])} dimensions")
             return embeddings
@@ -250,14 +315,17 @@ class AIService:
                 print("Debug: Screenplay is empty or has insufficient content")
                 return False
             
-            # Check if screenplay has actual text content
-            total_text = ""
+            # Check if screenplay has actual text content. Only count until
+            # the minimum is reached instead of building the whole script text.
+            text_length = 0
             for line in screenplay.lines:
-                if hasattr(line, 'text') and line.text.strip():
-                    total_text += line.text + " "
+                if hasattr(line, 'text'):
+                    text_length += len(line.text.strip())
+                    if text_length >= 100:
+                        break
             
-            if len(total_text.strip()) < 100:  # Require at least 100 characters
-                print(f"Debug: Screenplay has insufficient text content ({len(total_text)} chars)")
+            if text_length < 100:  # Require at least 100 characters
+                print(f"Debug: Screenplay has insufficient text content ({text_length} chars)")
                 return False
             
             # Chunk the screenplay
@@ -297,6 +365,7 @@ class AIService:
                 metadatas=metadatas,
                 ids=ids
             )
+            self._collection_info = None
             
             print(f"Debug: Successfully stored {len(chunks)} scene embeddings in ChromaDB")
             return True
@@ -313,23 +382,34 @@ class AIService:
             screenplay: Trelby screenplay object
             
         Returns:
-            List with a single chunk containing the entire screenplay
+            List with a single chunk containing the text of the screenplay,
+            truncated to FALLBACK_CHUNK_LIMIT characters
         """
         print("Debug: Creating fallback chunk...")
         
         try:
-            # Get all text from the screenplay
-            all_text = []
+            # Join the text of the lines, without the formatting's
+            # indentation, only up to as much of it as can be embedded
+            parts = []
+            length = 0
             for line in screenplay.lines:
-                all_text.append(line.text)
+                if length > FALLBACK_CHUNK_LIMIT:
+                    break
+                parts.append(line.text)
+                length += len(line.text) + 1
             
-            screenplay_text = "\n".join(all_text)
+            screenplay_text = "\n".join(parts)
+            truncated = len(screenplay_text) > FALLBACK_CHUNK_LIMIT or len(parts) < len(screenplay.lines)
+            screenplay_text = screenplay_text[:FALLBACK_CHUNK_LIMIT]
             
             if not screenplay_text.strip():
                 print("Debug: No text content found in screenplay")
                 return []
             
-            print(f"Debug: Fallback chunk has {len(screenplay_text)} characters")
+            if truncated:
+                print(f"Debug: Fallback chunk truncated to {len(screenplay_text)} characters")
+            else:
+                print(f"Debug: Fallback chunk has {len(screenplay_text)} characters")
             
             # Create a single chunk
             chunk = {
@@ -337,7 +417,7 @@ class AIService:
                 'metadata': {
                     'type': 'fallback',
                     'scene_number': 1,
-                    'scene_heading': 'Entire Screenplay',
+                    'scene_heading': 'Start of Screenplay' if truncated else 'Entire Screenplay',
                     'line_number': 0,
                     'element_type': 'fallback',
                     'total_lines': len(screenplay.lines)
@@ -476,6 +556,7 @@ For formatting tasks, return only the formatted content as requested."""
             
             print("Debug: Calling Claude API with simple prompt...")
             
+            self.rate_limiter.acquire()
             response = self.claude_client.messages.create(
                 model="claude-3-5-sonnet-20241022",
                 max_tokens=2000,  # Higher limit for formatting
@@ -486,6 +567,10 @@ For formatting tasks, return only the formatted content as requested."""
             response_text = response.content[0].text
             print(f"Debug: Simple API call successful, response length: {len(response_text)} characters")
             return response_text
+        except anthropic.RateLimitError as e:
+            print(f"Debug: Simple API call was rate limited: {e}")
+            self.rate_limiter.backoff()
+            return f"Error: {str(e)}"
         except Exception as e:
             print(f"Debug: Simple API call failed with error: {e}")
             return f"Error: {str(e)}"
@@ -511,13 +596,9 @@ For formatting tasks, return only the formatted content as requested."""
             # If an external AI service is provided, use it directly
             if ai_service:
                 print("Debug: Using external AI service for response")
-                # Combine context with user message for the external service
-                if context and context.strip():
-                    enhanced_message = f"{user_message}\n\nCONTEXT:\n{context}"
-                else:
-                    enhanced_message = user_message
-                
-                return ai_service.get_response(enhanced_message, "", conversation_history)
+                # Pass the context separately so the service can put it
+                # after the part of the prompt it caches
+                return ai_service.get_response(user_message, context, conversation_history)
             
             # Get semantic context from similar scenes
             print("Debug: Getting semantic context...")
@@ -595,14 +676,13 @@ CONVERSATION MEMORY:
             # Add conversation history if provided
             if conversation_history:
                 print(f"Debug: Including {len(conversation_history)} previous messages in conversation")
-                for i, msg in enumerate(conversation_history):
+                for msg in conversation_history:
                     if msg['message'].strip():  # Only add non-empty messages
                         role = "user" if msg['is_user'] else "assistant"
                         messages.append({
                             "role": role,
                             "content": msg['message']
                         })
-                        print(f"Debug: Added message {i+1}: {role} ({len(msg['message'])} chars)")
             
             # Send context update as a user message if context changed
             if context_changed:
@@ -647,6 +727,7 @@ CONVERSATION MEMORY:
             print(f"Debug: Total messages: {len(messages)}")
             print("Debug: Calling Claude API...")
             
+            self.rate_limiter.acquire()
             response = self.claude_client.messages.create(
                 model="claude-3-5-sonnet-20241022",
                 max_tokens=500,
@@ -657,20 +738,50 @@ CONVERSATION MEMORY:
             response_text = response.content[0].text
             print(f"Debug: Claude API call successful, response length: {len(response_text)} characters")
             return response_text
+        except anthropic.RateLimitError as e:
+            print(f"Debug: Enhanced API call was rate limited: {e}")
+            self.rate_limiter.backoff()
+            return f"Error: {str(e)}"
         except Exception as e:
             print(f"Debug: Enhanced API call failed with error: {e}")
             return f"Error: {str(e)}"
     
+    def get_response_stream(self, user_message: str, context: str = "", conversation_history: List[Dict] = None, ai_service=None, image: Optional[Dict] = None):
+        """
+        Get AI response as a stream of text pieces.
+        
+        Takes the same arguments as get_response, and optionally an image
+        dictionary as taken by the AI services, which is only sent by an
+        external AI service. Responses from an external AI service are
+        streamed as they are generated; responses from the internal Claude
+        client arrive as a single piece. If getting the
+        response fails, the last piece is a StreamError.
+        
+        Returns:
+            Iterator over pieces of the AI response string
+        """
+        if ai_service:
+            print("Debug: Streaming response from external AI service")
+            return ai_service.get_response_stream(user_message, context, conversation_history, image)
+        
+        return error_stream(self.get_response(user_message, context, conversation_history))
+    
     def get_collection_info(self) -> Dict:
         """Get information about the ChromaDB collection."""
+        # The collection only changes through this class, which drops the
+        # cached info whenever it does
+        if self._collection_info is not None:
+            return dict(self._collection_info)
+        
         try:
             count = self.collection.count()
             print(f"Debug: Collection '{self.collection_name}' has {count} documents")
-            return {
+            self._collection_info = {
                 'collection_name': self.collection_name,
                 'document_count': count,
                 'status': 'active'
             }
+            return dict(self._collection_info)
         except Exception as e:
             print(f"Debug: Error getting collection info: {e}")
             return {
@@ -679,6 +790,82 @@ CONVERSATION MEMORY:
                 'status': f'error: {e}'
             }
     
+    def use_collection(self, collection_name: str) -> int:
+        """
+        Switch to the given ChromaDB collection, creating it if needed.
+        
+        Collections are persisted on disk, so a collection stored in an
+        earlier session can be used again without creating its embeddings.
+        
+        Args:
+            collection_name: Name of ChromaDB collection for embeddings
+            
+        Returns:
+            Number of documents already in the collection
+        """
+        if collection_name != self.collection_name:
+            print(f"Debug: Switching to ChromaDB collection: {collection_name}")
+            self.collection = self.chroma_client.get_or_create_collection(name=collection_name)
+            self.collection_name = collection_name
+            self._collection_info = None
+            
+            # Remember when the collection was last used, see prune_collections
+            try:
+                self.collection.modify(metadata={"last_used": time.time()})
+            except Exception as e:
+                print(f"Debug: Error updating collection metadata: {e}")
+        
+        return self.collection.count()
+    
+    def prune_collections(self, prefix: str, keep: int = MAX_STORED_COLLECTIONS) -> int:
+        """
+        Delete all but the most recently used ChromaDB collections whose
+        names start with prefix. The collection in use is always kept.
+        
+        Args:
+            prefix: Name prefix of the collections to prune
+            keep: Number of collections to keep, including the one in use
+            
+        Returns:
+            Number of collections deleted
+        """
+        try:
+            stored = []
+            for collection in self.chroma_client.list_collections():
+                # Newer ChromaDB versions only list the names
+                if isinstance(collection, str):
+                    collection = self.chroma_client.get_collection(name=collection)
+                
+                if collection.name.startswith(prefix) and collection.name != self.collection_name:
+                    last_used = (collection.metadata or {}).get("last_used", 0)
+                    stored.append((last_used, collection.name))
+        except Exception as e:
+            print(f"Debug: Error listing collections: {e}")
+            return 0
+        
+        stored.sort(reverse=True)
+        
+        deleted = 0
+        for _, name in stored[max(keep - 1, 0):]:
+            if self.delete_collection(name):
+                deleted += 1
+        
+        return deleted
+    
+    def delete_collection(self, collection_name: str) -> bool:
+        """Delete a ChromaDB collection that is no longer needed."""
+        if collection_name == self.collection_name:
+            print(f"Debug: Not deleting the collection in use: {collection_name}")
+            return False
+        
+        try:
+            self.chroma_client.delete_collection(name=collection_name)
+            print(f"Debug: Deleted ChromaDB collection: {collection_name}")
+            return True
+        except Exception as e:
+            print(f"Debug: Error deleting collection {collection_name}: {e}")
+            return False
+    
     def clear_embeddings(self) -> bool:
         """Clear all embeddings from the collection."""
         try:
@@ -686,6 +873,7 @@ CONVERSATION MEMORY:
             ids = self.collection.get()["ids"]
             if ids:
                 self.collection.delete(ids=ids)
+                self._collection_info = None
                 print(f"Debug: Cleared {len(ids)} embeddings from collection")
             else:
                 print("Debug: No embeddings to clear")
@@ -726,6 +914,9 @@ CONVERSATION MEMORY:
     def _init_chromadb(self, collection_name: str):
         """Initialize ChromaDB with the specified collection"""
         self.collection_name = collection_name
+        
+        # Cached result of get_collection_info
+        self._collection_info = None
         print(f"Debug: Initializing ChromaDB with collection: {collection_name}")
         
         try:
@@ -734,4 +925,13 @@ CONVERSATION MEMORY:
             print(f"Debug: Created new ChromaDB collection: {collection_name}")
         except Exception as e:
             print(f"Debug: Error initializing ChromaDB: {e}")
-            raise 
\ No newline at end of file
+            raise
+    
+    def _init_embedding_cache(self):
+        """Open the on-disk embedding cache, embeddings work without it"""
+        try:
+            self.embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH)
+            print(f"Debug: Embedding cache opened: {EMBEDDING_CACHE_PATH}")
+        except Exception as e:
+            print(f"Debug: Error opening embedding cache: {e}")
+            self.embedding_cache = None 
\ No newline at end of file
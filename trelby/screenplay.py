@@ -24,6 +24,7 @@ SHOT = 7
 NOTE = 8
 ACTBREAK = 9
 
+import collections
 import copy
 import difflib
 import re
@@ -94,6 +95,16 @@ class Screenplay:
         # load/save/creation.
         self.hasChanged = False
 
+        # revision number, incremented on every change. used to know when
+        # values computed from the lines and cached need to be recomputed.
+        self.rev = 0
+
+        # cached results of getSceneLocations, getCharacterNames and
+        # getTypeCounts, in a (rev, value) format
+        self.sceneLocsCache = (-1, None)
+        self.charNamesCache = (-1, None)
+        self.typeCountsCache = (-1, None)
+
         # first/last undo objects (undo.Base)
         self.firstUndo = None
         self.lastUndo = None
@@ -119,6 +130,7 @@ class Screenplay:
 
     def markChanged(self, state=True):
         self.hasChanged = state
+        self.rev += 1
 
     def cursorAsMark(self):
         return Mark(self.line, self.column)
@@ -1933,6 +1945,9 @@ Generated with <a href="http://www.trelby.org">Trelby</a>.</p>
     # is not included in this list. note that the sceneNumber in the
     # returned list is a string, not a number.
     def getSceneLocations(self):
+        if self.sceneLocsCache[0] == self.rev:
+            return list(self.sceneLocsCache[1])
+
         ls = self.lines
         sc = SCENE
         scene = 0
@@ -1943,7 +1958,9 @@ Generated with <a href="http://www.trelby.org">Trelby</a>.</p>
                 scene += 1
                 ret.append((str(scene), i))
 
-        return ret
+        self.sceneLocsCache = (self.rev, ret)
+
+        return list(ret)
 
     # return a dictionary of all scene names (single-line text elements
     # only, upper-cased, values = None).
@@ -1959,6 +1976,9 @@ Generated with <a href="http://www.trelby.org">Trelby</a>.</p>
     # return a dictionary of all character names (single-line text
     # elements only, lower-cased, values = None).
     def getCharacterNames(self):
+        if self.charNamesCache[0] == self.rev:
+            return dict(self.charNamesCache[1])
+
         names = {}
 
         ul = util.lower
@@ -1967,7 +1987,20 @@ Generated with <a href="http://www.trelby.org">Trelby</a>.</p>
             if (ln.lt == CHARACTER) and (ln.lb == LB_LAST):
                 names[ul(ln.text)] = None
 
-        return names
+        self.charNamesCache = (self.rev, names)
+
+        return dict(names)
+
+    # return a collections.Counter of how many lines of each type (the
+    # line types, e.g. ACTION, are the keys) the script has.
+    def getTypeCounts(self):
+        if self.typeCountsCache[0] != self.rev:
+            self.typeCountsCache = (
+                self.rev,
+                collections.Counter([ln.lt for ln in self.lines]),
+            )
+
+        return collections.Counter(self.typeCountsCache[1])
 
     # get next word, starting at (line, col). line must be valid, but col
     # can point after the line's length, in which case the search starts
@@ -2187,8 +2220,9 @@ Generated with <a href="http://www.trelby.org">Trelby</a>.</p>
         return (line >= marked[0]) and (line <= marked[1])
 
     # get selected text as a ClipData object, optionally deleting it from
-    # the script. if nothing is selected, returns None.
-    def getSelectedAsCD(self, doDelete):
+    # the script. if nothing is selected, returns None. if doUndo is
+    # False, the caller is responsible for recording the undo action.
+    def getSelectedAsCD(self, doDelete, doUndo=True):
         marked = self.getMarkedLines()
 
         if not marked:
@@ -2210,7 +2244,8 @@ Generated with <a href="http://www.trelby.org">Trelby</a>.</p>
         if not doDelete:
             return cd
 
-        u = undo.AnyDifference(self)
+        if doUndo:
+            u = undo.AnyDifference(self)
 
         # range of lines, inclusive, that we need to totally delete
         del1 = sys.maxsize
@@ -2293,17 +2328,63 @@ Generated with <a href="http://www.trelby.org">Trelby</a>.</p>
         self.rewrapElem()
         self.markChanged()
 
+        if doUndo:
+            u.setAfter(self)
+            self.addUndo(u)
+
+        return cd
+
+    # replace selected text with clines, a list of Line objects, as a
+    # single undoable action. returns False if nothing is selected.
+    def replaceSelected(self, clines):
+        marked = self.getMarkedLines()
+
+        if not marked:
+            return False
+
+        u = undo.AnyDifference(self)
+
+        ls = self.lines
+
+        # if whole elements are selected, the new lines must become
+        # elements of their own in their place, instead of being pasted
+        # into the start of the element following them
+        c1 = self.getMarkedColumns(marked[0], marked)[0]
+        c2 = self.getMarkedColumns(marked[1], marked)[1]
+
+        wholeElems = (
+            (c1 == 0)
+            and self.isFirstLineOfElem(marked[0])
+            and (c2 >= len(ls[marked[1]].text) - 1)
+            and self.isLastLineOfElem(marked[1])
+        )
+
+        # if everything is selected, deleting it leaves a single empty
+        # line, which is pasted into
+        allSelected = (marked[0] == 0) and (marked[1] == len(ls) - 1)
+
+        self.getSelectedAsCD(True, False)
+
+        if wholeElems and not allSelected and clines:
+            ls.insert(marked[0], Line(LB_LAST, clines[0].lt))
+            self.line = marked[0]
+            self.column = 0
+
+        self.paste(clines, False)
+
         u.setAfter(self)
         self.addUndo(u)
 
-        return cd
+        return True
 
-    # paste data into script. clines is a list of Line objects.
-    def paste(self, clines):
+    # paste data into script. clines is a list of Line objects. if doUndo
+    # is False, the caller is responsible for recording the undo action.
+    def paste(self, clines, doUndo=True):
         if len(clines) == 0:
             return
 
-        u = undo.AnyDifference(self)
+        if doUndo:
+            u = undo.AnyDifference(self)
 
         inLines = []
         i = 0
@@ -2378,8 +2459,9 @@ Generated with <a href="http://www.trelby.org">Trelby</a>.</p>
 
         self.reformatRange(wrap1, self.getParaFirstIndexFromLine(self.line))
 
-        u.setAfter(self)
-        self.addUndo(u)
+        if doUndo:
+            u.setAfter(self)
+            self.addUndo(u)
 
         self.clearMark()
         self.clearAutoComp()
@@ -65,8 +65,18 @@ Input text:
 Return ONLY the Fountain-formatted text, no explanations or commentary."""
 
     try:
-        # Use simple response method to avoid semantic search and complex context
-        response = ai_service.get_simple_response(prompt, ai_service)
+        # Use simple response method to avoid semantic search and complex
+        # context. The chat services don't have one and are asked directly.
+        if hasattr(ai_service, 'get_simple_response'):
+            response = ai_service.get_simple_response(prompt)
+        else:
+            response = ai_service.get_response(prompt)
+        
+        # Services report errors as the response text
+        if response.startswith("Error"):
+            print(f"AI formatting error: {response}")
+            return text
+        
         return response.strip()
     except Exception as e:
         print(f"AI formatting error: {e}")
@@ -78,7 +88,8 @@ def convert_to_lines(fountain_text):
     to correctly identify elements like dialogue.
     """
     lines = []
-    fountain_lines = fountain_text.strip().split('\n')
+    fountain_lines = fountain_text.strip().splitlines()
+    last = len(fountain_lines) - 1
     
     # Enhanced state tracking
     last_line_type = None
@@ -91,9 +102,7 @@ def convert_to_lines(fountain_text):
         formatted_text = line_text
 
         # Determine line break type
-        lb = LB_FORCED
-        if i == len(fountain_lines) - 1:
-            lb = LB_LAST
+        lb = LB_LAST if i == last else LB_FORCED
         
         # Enhanced line type detection with better context awareness
         if not line_text:
@@ -4,6 +4,7 @@ import copy
 import os
 import os.path
 import signal
+import threading
 import webbrowser
 from functools import partial
 
@@ -1028,6 +1029,9 @@ class MyFrame(wx.Frame):
             )
             return
         
+        # Create the AI service now if it hasn't been used yet
+        self.aiAssistantPanel.ensure_ai_service()
+        
         # Create and show the AI rewrite dialog
         from trelby.ai_rewrite import AIRewrite
         dialog = AIRewrite(self, self.aiAssistantPanel.ai_service, selected_text)
@@ -1059,52 +1063,68 @@ class MyFrame(wx.Frame):
             )
             return
         
-        # Format the selected text using intelligent formatting with AI
-        try:
-            # Get the current selection
-            cd = current_ctrl.sp.getSelectedAsCD(False)
-            if not cd:
-                return
-            
-            # Use the existing cut functionality to delete selected text
-            current_ctrl.OnCut(doDelete=True, copyToClip=False)
-            
-            # Get AI service if available
-            ai_service = None
-            if hasattr(self, 'aiAssistantPanel') and self.aiAssistantPanel:
-                ai_service = self.aiAssistantPanel.embedding_ai_service
-            
-            # Use intelligent formatting with AI service to create properly formatted lines
-            from trelby.screenplay_formatter import fix_formatting
-            lines = fix_formatting(selected_text, ai_service)
-            
-            # Use Trelby's paste functionality to insert the formatted text
-            if lines:
-                current_ctrl.sp.paste(lines)
-            else:
-                # If formatting failed, restore the original text
-                current_ctrl.sp.paste([current_ctrl.sp.lines[0].__class__(current_ctrl.sp.LB_LAST, current_ctrl.sp.ACTION, selected_text)])
-                wx.MessageBox(
-                    "Formatting failed. Original text has been restored.",
-                    "Formatting Error",
-                    wx.OK | wx.ICON_WARNING,
-                    self
-                )
-                
-        except Exception as e:
-            # Restore original text on error
+        # Get the current selection. It is kept until the formatted text is
+        # ready to replace it, so that nothing is lost if formatting fails.
+        cd = current_ctrl.sp.getSelectedAsCD(False)
+        if not cd:
+            return
+        
+        selected = [(ln.lt, ln.text) for ln in cd.lines]
+        panel = getattr(self, 'aiAssistantPanel', None)
+        
+        # Asking the AI service takes a while and may have to wait for its
+        # rate limiter, so format the text in the background
+        def format_thread():
             try:
-                current_ctrl.sp.paste([current_ctrl.sp.lines[0].__class__(current_ctrl.sp.LB_LAST, current_ctrl.sp.ACTION, selected_text)])
-            except:
-                pass
-            
+                # Get AI service if available, creating it now if the AI
+                # assistant hasn't been used yet
+                ai_service = None
+                if panel:
+                    panel.ensure_embedding_services()
+                    ai_service = panel.embedding_ai_service
+                
+                # Use intelligent formatting with AI service to create properly formatted lines
+                from trelby.screenplay_formatter import fix_formatting
+                lines = fix_formatting(selected_text, ai_service)
+                
+                wx.CallAfter(self.replaceFormattedText, current_ctrl, selected, lines, bool(ai_service))
+            except Exception as e:
+                wx.CallAfter(self.showFormatError, f"Error formatting text: {str(e)}")
+        
+        threading.Thread(target=format_thread, daemon=True).start()
+
+    def replaceFormattedText(self, ctrl, selected, lines, usedAI):
+        """Replace the formatted selection with the formatted lines (main thread)"""
+        # The script may have been closed while the text was formatted
+        if not ctrl:
+            return
+        
+        if not lines:
+            self.showFormatError("Formatting failed. The original text was kept.")
+            return
+        
+        cd = ctrl.sp.getSelectedAsCD(False)
+        if not cd or ([(ln.lt, ln.text) for ln in cd.lines] != selected):
+            self.showFormatError("The selection changed while the text was formatted. "
+                                 "The original text was kept.")
+            return
+        
+        ctrl.sp.replaceSelected(lines)
+        ctrl.makeLineVisible(ctrl.sp.line)
+        ctrl.updateScreen()
+        
+        if not usedAI:
             wx.MessageBox(
-                f"Error formatting text: {str(e)}",
-                "Error",
-                wx.OK | wx.ICON_ERROR,
+                "AI formatting is not available, so the text was formatted using basic rules only.",
+                "AI Not Available",
+                wx.OK | wx.ICON_INFORMATION,
                 self
             )
 
+    def showFormatError(self, message):
+        """Tell the user that formatting the selection failed (main thread)"""
+        wx.MessageBox(message, "Formatting Error", wx.OK | wx.ICON_WARNING, self)
+
     def OnTableRead(self, event=None):
         from trelby.table_read_dialog import TableReadDialog
         dlg = TableReadDialog(self, self.panel.ctrl.sp)